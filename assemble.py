@@ -3,6 +3,7 @@ from assembler.grammar import program
 from struct import pack
 from collections import defaultdict
 from sys import argv
+import os
 
 
 symtable_label = {}
@@ -71,5 +72,13 @@ if __name__ == "__main__":
         raise Exception("Unresolved labels: " + repr(label_pending))
 
 
-with open("image", "wb") as f:
+# Machines map their image, so write a new one and move it into place
+# rather than changing the one they have under them
+with open("image.new", "wb") as f:
     f.write(bytearray(output))
+os.replace("image.new", "image")
+
+# Labels, so the machine can be told to run to one
+with open("image.sym", "w") as f:
+    for name, addr in symtable_label.items():
+        f.write(f"{name} {addr:08x}\n")
@@ -50,7 +50,9 @@ reg_map = {
     "vaddr" : 0x26,
     "va" : 0x26,
     "baseptr" : 0x27,
-    "bp": 0x27
+    "bp": 0x27,
+    "sysvec" : 0x2a,
+    "sv" : 0x2a
 }
 
 
@@ -183,7 +185,9 @@ inst_ops = [
     ("shri", inst_op_reg_immed_reg),
     ("cpuid", None),
     ("strapr", inst_op_reg_addr),
-    ("strapi", inst_op_immed_addr)
+    ("strapi", inst_op_immed_addr),
+    ("syscall", None),
+    ("sysret", None)
 ]
     
 def keyword_parse_action(i, tok):
@@ -0,0 +1,167 @@
+from .cpu import CPU
+from .memory import Memory
+from . import translator as codegen
+import hashlib
+import importlib.util
+import os
+
+
+# Where translated images are kept, one module per image and translator
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "compyter")
+
+# Modules from another version of the translator may emit code this one
+# wouldn't, e.g. without privilege checks, so they're never used
+with open(codegen.__file__, 'rb') as f:
+    TRANSLATOR_HASH = hashlib.sha256(f.read()).hexdigest()
+
+# Operand types of each instruction, by handler name
+ARG_TYPES = {fn.__name__: [t for t in instr_type if t != CPU.IA_NONE]
+             for instr_type, fn in CPU.INSTRS}
+
+# Instructions whose immediates are usually code pointers, such as return
+# addresses and interrupt handlers
+POINTER_IMMEDIATES = frozenset(("loadwi", "savewi", "savewri"))
+
+
+def _stat_path(filename, st, cache_dir=None):
+    if cache_dir is None:
+        cache_dir = CACHE_DIR
+
+    # Where we note the hash of this file as it is now. The assembler always
+    # writes a new file, so a different inode or mtime means new contents.
+    ident = (f"{os.path.realpath(filename)}:{st.st_ino}:{st.st_size}:"
+             f"{st.st_mtime_ns}")
+    return os.path.join(cache_dir, "stat", hashlib.sha256(ident.encode()).hexdigest())
+
+
+def _write(path, text):
+    # Write then rename, so concurrent starts never see half a file
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+
+    os.replace(tmp_path, path)
+
+
+def image_hash(filename, cache_dir=None):
+    # Hash of the image's contents. Reading a big image every time we start
+    # would be slow, so it's noted in the cache against the file as it is
+    # now and only read again once that changes.
+    with open(filename, 'rb') as f:
+        stat_path = _stat_path(filename, os.fstat(f.fileno()), cache_dir)
+        try:
+            with open(stat_path) as cached:
+                return cached.read().strip()
+        except FileNotFoundError:
+            pass
+
+        digest = hashlib.sha256(f.read()).hexdigest()
+
+    _write(stat_path, digest + "\n")
+    return digest
+
+
+def image_key(digest):
+    # Names the translation of the image with this hash by this translator,
+    # so a copy of an image anywhere uses the same one
+    return hashlib.sha256(f"{digest}:{TRANSLATOR_HASH}".encode()).hexdigest()
+
+
+def module_path(key, cache_dir=None):
+    if cache_dir is None:
+        cache_dir = CACHE_DIR
+
+    return os.path.join(cache_dir, f"image_{key}.py")
+
+
+def _static_targets(pc, instrs, size):
+    # Addresses we can prove (or reasonably guess) are code
+    targets = []
+    for name, args in instrs:
+        # Branch and trap targets, plus immediates that look like code
+        # pointers. Wrong guesses only cost an unused translation.
+        for argtype, arg in zip(ARG_TYPES[name], args):
+            if arg >= size:
+                continue
+
+            if name.startswith(("jmp", "strap")) and argtype == CPU.IA_ADDR:
+                targets.append(arg)
+            elif name in POINTER_IMMEDIATES and argtype == CPU.IA_IMMED:
+                targets.append(arg)
+
+    last = instrs[-1][0]
+    if last not in ("jmp", "jmpr", "halt", "rfe", "sysret"):
+        # Fallthrough
+        targets.append(pc + (len(instrs) * 16))
+
+    return targets
+
+
+def find_blocks(translator, roots=(0,)):
+    size = len(translator.memory)
+    blocks = {}
+    work = list(roots)
+    while work:
+        pc = work.pop()
+        if pc in blocks or pc + 16 > size:
+            continue
+
+        instrs = translator.scan(pc)
+        if not instrs:
+            continue
+
+        blocks[pc] = instrs
+        work.extend(_static_targets(pc, instrs, size))
+
+    return blocks
+
+
+def translate_image(filename, cache_dir=None):
+    digest = image_hash(filename, cache_dir)
+    key = image_key(digest)
+    path = module_path(key, cache_dir)
+
+    translator = CPU(Memory.load_file(filename)).translator
+
+    lines = [
+        f"# Translated from image {digest}; generated, do not edit",
+        f"IMAGE_KEY = {key!r}",
+        f"IMAGE_HASH = {digest!r}",
+        f"TRANSLATOR_HASH = {TRANSLATOR_HASH!r}",
+        "",
+    ]
+
+    table = []
+    for pc, instrs in sorted(find_blocks(translator).items()):
+        name, source = translator.generate(pc, instrs)
+        lines.append(source)
+        table.append(f"    {pc:#x}: ({name}, {len(instrs)}),")
+
+    lines.append("BLOCKS = {")
+    lines.extend(table)
+    lines.append("}")
+
+    _write(path, "\n".join(lines) + "\n")
+    return path
+
+
+def load_translations(cpu, filename, cache_dir=None):
+    digest = image_hash(filename, cache_dir)
+    key = image_key(digest)
+    path = module_path(key, cache_dir)
+    if not os.path.exists(path):
+        return False
+
+    spec = importlib.util.spec_from_file_location(f"image_{key}", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    if (getattr(module, "IMAGE_HASH", None) != digest or
+            getattr(module, "TRANSLATOR_HASH", None) != TRANSLATOR_HASH):
+        return False
+
+    for pc, (fn, length) in module.BLOCKS.items():
+        cpu.translator.install(pc, fn, length)
+
+    return True
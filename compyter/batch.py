@@ -0,0 +1,420 @@
+from .cpu import CPU
+from .memory import Memory
+from .register import RegisterName, RegisterFile
+import numpy as np
+
+
+REG_PC = int(RegisterName.REG_PC)
+REG_CARRY = int(RegisterName.REG_CARRY)
+REG_RES = int(RegisterName.REG_RES)
+MASK = np.uint64(0xffffffff)
+
+
+class BatchEngine:
+    # Runs many copies of one image in lockstep. Instances at the same PC
+    # execute each instruction together as array operations; anything that
+    # needs devices, traps or privileged state is handed to a scalar CPU.
+
+    # Registers the lockstep path won't touch: the interpreter owns these
+    SCALAR_REGS = frozenset(RegisterFile.PRIV_REGS + RegisterFile.DIS_REGS)
+
+    def __init__(self, filename, count, attach=None):
+        image = Memory.load_file(filename).memory
+        self.count = count
+        self.size = len(image)
+        self.attach = attach
+
+        self.regs = np.zeros((count, RegisterName.REG_LAST), dtype=np.uint32)
+        self.mem = np.tile(np.frombuffer(bytes(image), dtype=np.uint8), (count, 1))
+
+        self.active = np.ones(count, dtype=bool)
+        self.halted = np.zeros(count, dtype=bool)
+        # Instructions each instance has run, lockstep or scalar
+        self.steps = np.zeros(count, dtype=np.int64)
+        self.scalar = {}
+        self.decoded = {}
+
+    def _decode(self, code):
+        instr = self.decoded.get(code)
+        if instr is not None:
+            return instr
+
+        words = [int.from_bytes(code[i:i+4], "big") for i in range(0, 16, 4)]
+        if words[0] >= len(CPU.INSTRS):
+            return None
+
+        instr_type, instr_fn = CPU.INSTRS[words[0]]
+        args = []
+        for argtype, arg in zip(instr_type, words[1:]):
+            if argtype == CPU.IA_NONE:
+                continue
+            elif argtype == CPU.IA_REG and arg in self.SCALAR_REGS:
+                return None
+
+            args.append(arg)
+
+        op = getattr(self, "_op_" + instr_fn.__name__.rstrip("_"), None)
+        if op is None:
+            return None
+
+        instr = (op, tuple(args))
+        self.decoded[code] = instr
+        return instr
+
+    def _detach(self, idx, pc):
+        # Move instances to a scalar CPU at pc; they stay there until they
+        # halt.
+        for i in idx:
+            memory = Memory(bytearray(self.mem[i].tobytes()))
+            cpu = CPU(memory)
+            cpu.registers.load(int(x) for x in self.regs[i])
+            cpu.registers.registers[REG_PC] = pc
+            if self.attach is not None:
+                self.attach(cpu, memory)
+
+            self.scalar[int(i)] = cpu
+            self.active[i] = False
+
+    def step(self):
+        active = np.flatnonzero(self.active)
+        if not len(active):
+            return False
+
+        pcs = self.regs[active, REG_PC]
+        for pc in np.unique(pcs):
+            self._execute(int(pc), active[pcs == pc])
+
+        return True
+
+    def _execute(self, pc, idx):
+        if pc + 16 > self.size:
+            self._detach(idx, pc)
+            return
+
+        # Instances that rewrote this instruction go their own way
+        code = self.mem[idx, pc:pc+16]
+        same = (code == code[0]).all(axis=1)
+        if not same.all():
+            self._detach(idx[~same], pc)
+            idx = idx[same]
+
+        instr = self._decode(code[0].tobytes())
+        if instr is None:
+            self._detach(idx, pc)
+            return
+
+        op, args = instr
+        self.regs[idx, REG_PC] = pc + 16
+        bad = op(idx, *args)
+        if bad is not None and bad.any():
+            # These run it again on the scalar path
+            self._detach(idx[bad], pc)
+            idx = idx[~bad]
+
+        self.steps[idx] += 1
+
+    def run(self, max_steps=None, quantum=1000):
+        # No instance runs more than max_steps instructions
+        started = self.steps.copy()
+        steps = 0
+        while (max_steps is None or steps < max_steps) and self.step():
+            steps += 1
+
+        for i, cpu in self.scalar.items():
+            if self.halted[i]:
+                continue
+
+            # What's left of this instance's own budget; it may have left
+            # the lockstep path long before the others stopped
+            budget = None if max_steps is None else max_steps - int(self.steps[i] - started[i])
+            self.steps[i] += self._run_scalar(cpu, budget, quantum)
+
+            self.regs[i] = [x & 0xffffffff for x in cpu.registers.registers]
+            self.mem[i] = np.frombuffer(bytes(cpu.memory.memory), dtype=np.uint8)
+            self.halted[i] = cpu.halted
+
+        return steps
+
+    def _run_scalar(self, cpu, budget, quantum):
+        # Run cpu until it halts or has run budget instructions, if given.
+        # Returns how many it ran.
+        ran = 0
+        while not cpu.halted and (budget is None or ran < budget):
+            if budget is None:
+                ran += cpu.run(quantum)
+                continue
+
+            ran += cpu.run(min(quantum, budget - ran), park=False, limit=budget - ran)
+            if cpu.waiting or cpu.spinning:
+                # There may be nothing to wake it, so only give the devices
+                # a moment; the budget runs out either way
+                if self.attach is not None:
+                    event = cpu.trap_event if cpu.waiting else cpu.wake_event
+                    event.wait(cpu.SPIN_PARK)
+                    cpu.wake_event.clear()
+
+                cpu.waiting = cpu.spinning = False
+
+        return ran
+
+    # Helpers
+    def _get(self, idx, reg):
+        return self.regs[idx, reg].astype(np.uint64)
+
+    def _set(self, idx, reg, val):
+        self.regs[idx, reg] = (val & MASK).astype(np.uint32)
+
+    def _const(self, idx, val):
+        return np.full(len(idx), val, dtype=np.uint64)
+
+    @staticmethod
+    def _signed(val):
+        return val.astype(np.uint32).view(np.int32).astype(np.int64)
+
+    # Instructions
+    def _op_nop(self, idx):
+        pass
+
+    def _op_halt(self, idx):
+        self.active[idx] = False
+        self.halted[idx] = True
+
+    def _op_cpuid(self, idx):
+        self.regs[idx, REG_RES] = CPU.CPU_VERSION
+
+    def _op_loadwi(self, idx, reg, val):
+        self.regs[idx, reg] = val
+
+    def _op_loadbi(self, idx, reg, val):
+        self.regs[idx, reg] = val & 0xff
+
+    def _op_copy(self, idx, reg1, reg2):
+        self.regs[idx, reg1] = self.regs[idx, reg2]
+
+    def _op_swap(self, idx, reg1, reg2):
+        # Same as the interpreter, which stores the register number
+        temp = self.regs[idx, reg1]
+        self.regs[idx, reg1] = reg2
+        self.regs[idx, reg2] = temp
+
+    def _arith(self, idx, a, b, reg, fn, carry=True):
+        result = fn(a, b)
+        self._set(idx, reg, result)
+        self.regs[idx, REG_CARRY] = (result > MASK) if carry else 0
+
+    def _op_add(self, idx, reg1, reg2, reg3):
+        self._arith(idx, self._get(idx, reg1), self._get(idx, reg2), reg3, np.add)
+
+    def _op_addi(self, idx, reg1, val, reg2):
+        self._arith(idx, self._get(idx, reg1), np.uint64(val), reg2, np.add)
+
+    def _op_sub(self, idx, reg1, reg2, reg3):
+        # The interpreter adds the two's complement, which never carries
+        self._arith(idx, self._get(idx, reg1), self._get(idx, reg2), reg3,
+                    np.subtract, carry=False)
+
+    def _op_subi(self, idx, reg1, val, reg2):
+        self._arith(idx, self._get(idx, reg1), np.uint64(val), reg2,
+                    np.subtract, carry=False)
+
+    def _op_mul(self, idx, reg1, reg2, reg3):
+        self._arith(idx, self._get(idx, reg1), self._get(idx, reg2), reg3, np.multiply)
+
+    def _op_muli(self, idx, reg1, val, reg2):
+        self._arith(idx, self._get(idx, reg1), np.uint64(val), reg2, np.multiply)
+
+    @staticmethod
+    def _divmod(dividend, divisor):
+        # CPU._divmod() for arrays. Its restoring division only gives the
+        # true quotient for divisors below 0x80000000, so those take the
+        # quick way and the rest are worked out bit by bit, as it does.
+        quotient = dividend // np.maximum(divisor, 1)
+        remainder = dividend - (quotient * divisor)
+
+        odd = np.flatnonzero(divisor >= 0x80000000)
+        if len(odd):
+            q, d = dividend[odd], divisor[odd]
+            compl = (d ^ MASK) + np.uint64(1)
+            r = np.zeros(len(odd), dtype=np.uint64)
+            for _ in range(32):
+                carry = q >> np.uint64(31)
+                q = (q << np.uint64(1)) & MASK
+                r = ((r << np.uint64(1)) & MASK) | carry
+
+                test = (r + compl) & MASK
+                fits = (test & np.uint64(0x80000000)) == 0
+                r = np.where(fits, test, r)
+                q |= fits.astype(np.uint64)
+
+            quotient[odd], remainder[odd] = q, r
+
+        return quotient, remainder
+
+    def _divide(self, idx, a, b, reg, part):
+        # Division by zero traps, which is the scalar path's job
+        bad = (b == 0)
+        ok = ~bad
+        self._set(idx[ok], reg, self._divmod(a[ok], b[ok])[part])
+        self.regs[idx[ok], REG_CARRY] = 0
+        return bad
+
+    def _op_div(self, idx, reg1, reg2, reg3):
+        return self._divide(idx, self._get(idx, reg1), self._get(idx, reg2), reg3, 0)
+
+    def _op_divi(self, idx, reg1, val, reg2):
+        return self._divide(idx, self._get(idx, reg1), self._const(idx, val), reg2, 0)
+
+    def _op_mod(self, idx, reg1, reg2, reg3):
+        return self._divide(idx, self._get(idx, reg1), self._get(idx, reg2), reg3, 1)
+
+    def _op_modi(self, idx, reg1, val, reg2):
+        return self._divide(idx, self._get(idx, reg1), self._const(idx, val), reg2, 1)
+
+    def _op_and(self, idx, reg1, reg2, reg3):
+        self._set(idx, reg3, self._get(idx, reg1) & self._get(idx, reg2))
+
+    def _op_andi(self, idx, reg1, val, reg2):
+        self._set(idx, reg2, self._get(idx, reg1) & np.uint64(val))
+
+    def _op_or(self, idx, reg1, reg2, reg3):
+        self._set(idx, reg3, self._get(idx, reg1) | self._get(idx, reg2))
+
+    def _op_ori(self, idx, reg1, val, reg2):
+        self._set(idx, reg2, self._get(idx, reg1) | np.uint64(val))
+
+    def _op_xor(self, idx, reg1, reg2, reg3):
+        self._set(idx, reg3, self._get(idx, reg1) ^ self._get(idx, reg2))
+
+    def _op_xori(self, idx, reg1, val, reg2):
+        self._set(idx, reg2, self._get(idx, reg1) ^ np.uint64(val))
+
+    def _op_not(self, idx, reg1, reg2):
+        self._set(idx, reg2, ~self._get(idx, reg1))
+
+    def _shift(self, idx, a, b, reg, fn):
+        # Shifts of 32 or more clear the register, as they do in Python
+        big = (b >= 32)
+        result = fn(a, np.where(big, 0, b).astype(np.uint64))
+        self._set(idx, reg, np.where(big, 0, result))
+
+    def _op_shl(self, idx, reg1, reg2, reg3):
+        self._shift(idx, self._get(idx, reg1), self._get(idx, reg2), reg3, np.left_shift)
+
+    def _op_shli(self, idx, reg1, val, reg2):
+        self._shift(idx, self._get(idx, reg1), self._const(idx, val), reg2, np.left_shift)
+
+    def _op_shr(self, idx, reg1, reg2, reg3):
+        self._shift(idx, self._get(idx, reg1), self._get(idx, reg2), reg3, np.right_shift)
+
+    def _op_shri(self, idx, reg1, val, reg2):
+        self._shift(idx, self._get(idx, reg1), self._const(idx, val), reg2, np.right_shift)
+
+    # Memory; anything outside RAM (devices, trap vectors) goes scalar
+    def _load(self, idx, reg, addr, width):
+        bad = (addr + width > self.size)
+        ok = ~bad
+        idx, addr = idx[ok], addr[ok].astype(np.int64)
+
+        val = np.zeros(len(idx), dtype=np.uint64)
+        for i in range(width):
+            val = (val << np.uint64(8)) | self.mem[idx, addr + i]
+
+        self.regs[idx, reg] = val
+        return bad
+
+    def _store(self, idx, val, addr, width):
+        bad = (addr + width > self.size)
+        ok = ~bad
+        idx, val, addr = idx[ok], val[ok], addr[ok].astype(np.int64)
+
+        for i in range(width):
+            shift = np.uint64(8 * (width - i - 1))
+            self.mem[idx, addr + i] = ((val >> shift) & np.uint64(0xff)).astype(np.uint8)
+
+        return bad
+
+    def _op_loadw(self, idx, reg, addr):
+        return self._load(idx, reg, self._const(idx, addr), 4)
+
+    def _op_loadwr(self, idx, reg1, reg2):
+        return self._load(idx, reg1, self._get(idx, reg2), 4)
+
+    def _op_loadb(self, idx, reg, addr):
+        return self._load(idx, reg, self._const(idx, addr), 1)
+
+    def _op_loadbr(self, idx, reg1, reg2):
+        return self._load(idx, reg1, self._get(idx, reg2), 1)
+
+    def _op_savew(self, idx, reg, addr):
+        return self._store(idx, self._get(idx, reg), self._const(idx, addr), 4)
+
+    def _op_savewr(self, idx, reg1, reg2):
+        return self._store(idx, self._get(idx, reg1), self._get(idx, reg2), 4)
+
+    def _op_savewi(self, idx, val, addr):
+        return self._store(idx, self._const(idx, val), self._const(idx, addr), 4)
+
+    def _op_savewri(self, idx, val, reg):
+        return self._store(idx, self._const(idx, val), self._get(idx, reg), 4)
+
+    def _op_saveb(self, idx, reg, addr):
+        return self._store(idx, self._get(idx, reg), self._const(idx, addr), 1)
+
+    def _op_savebr(self, idx, reg1, reg2):
+        return self._store(idx, self._get(idx, reg1), self._get(idx, reg2), 1)
+
+    def _op_savebi(self, idx, val, addr):
+        return self._store(idx, self._const(idx, val), self._const(idx, addr), 1)
+
+    def _op_savebri(self, idx, val, reg):
+        return self._store(idx, self._const(idx, val), self._get(idx, reg), 1)
+
+    # Branches
+    def _op_jmp(self, idx, addr):
+        self.regs[idx, REG_PC] = addr
+
+    def _op_jmpr(self, idx, reg):
+        self.regs[idx, REG_PC] = self.regs[idx, reg]
+
+    def _branch(self, idx, cond, a, b, target):
+        if cond in ("lt", "gt", "le", "ge"):
+            a, b = self._signed(a), self._signed(b)
+
+        taken = {
+            "lt": np.less,
+            "gt": np.greater,
+            "le": np.less_equal,
+            "ge": np.greater_equal,
+            "eq": np.equal,
+            "ne": np.not_equal,
+        }[cond](a, b)
+
+        self.regs[idx[taken], REG_PC] = target[taken]
+
+
+def _make_branches():
+    # jmp<cond>, jmp<cond>i, jmp<cond>r and jmp<cond>ri for each condition
+    for cond in ("lt", "gt", "le", "ge", "eq", "ne"):
+        def reg_addr(self, idx, reg1, reg2, addr, cond=cond):
+            self._branch(idx, cond, self._get(idx, reg1), self._get(idx, reg2),
+                         self._const(idx, addr))
+
+        def immed_addr(self, idx, reg1, val, addr, cond=cond):
+            self._branch(idx, cond, self._get(idx, reg1), self._const(idx, val),
+                         self._const(idx, addr))
+
+        def reg_reg(self, idx, reg1, reg2, reg3, cond=cond):
+            self._branch(idx, cond, self._get(idx, reg1), self._get(idx, reg2),
+                         self._get(idx, reg3))
+
+        def immed_reg(self, idx, reg1, val, reg2, cond=cond):
+            self._branch(idx, cond, self._get(idx, reg1), self._const(idx, val),
+                         self._get(idx, reg2))
+
+        setattr(BatchEngine, f"_op_jmp{cond}", reg_addr)
+        setattr(BatchEngine, f"_op_jmp{cond}i", immed_addr)
+        setattr(BatchEngine, f"_op_jmp{cond}r", reg_reg)
+        setattr(BatchEngine, f"_op_jmp{cond}ri", immed_reg)
+
+
+_make_branches()
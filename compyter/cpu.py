@@ -1,8 +1,17 @@
 from .mmu import (MMU, PageFaultException, InvalidBasePointerException,
                    PTEAccess)
 from .register import RegisterName, StatusBit, PrivilegeException, RegisterFile
+from .translator import Translator
 from threading import RLock, Event
 from time import sleep
+from types import MethodType
+from collections import defaultdict, Counter
+
+
+class HaltException(Exception):
+    # Instructions a translated block ran before the halt, which itself
+    # doesn't count
+    ran = 0
 
 
 class CPU:
@@ -18,35 +27,110 @@ class CPU:
     TRAP_BBPTR = 0xfffff040
     TRAP_DFAULT = 0xffff050
 
-    def __init__(self, memory):
+    # Adjacent instruction sequences run as one handler once hot; longest
+    # sequences come first
+    FUSIONS = (
+        ("strapr", "addi", "jmpgei"),
+        ("addi", "jmplti"),
+        ("addi", "jmpgti"),
+        ("addi", "jmplei"),
+        ("addi", "jmpgei"),
+        ("addi", "jmpeqi"),
+        ("addi", "jmpnei"),
+        ("subi", "jmplti"),
+        ("subi", "jmpgti"),
+        ("subi", "jmplei"),
+        ("subi", "jmpgei"),
+        ("subi", "jmpeqi"),
+        ("subi", "jmpnei"),
+        ("addi", "savewr"),
+        ("loadwr", "subi"),
+        ("loadwi", "savew"),
+        ("loadwi", "savewr"),
+        ("strapr", "addi"),
+    )
+    FUSION_HEADS = frozenset(fusion[0] for fusion in FUSIONS)
+    FUSION_MAX = max(len(fusion) for fusion in FUSIONS)
+
+    # Executions of a fusion head before we try to fuse it
+    FUSION_THRESHOLD = 8
+
+    # Polling loops: at most SPIN_MAX instructions long, and doing only what
+    # these do. After SPIN_THRESHOLD iterations that leave the registers
+    # unchanged the CPU parks for up to SPIN_PARK seconds, or until a device
+    # or interrupt wakes it.
+    SPIN_MAX = 8
+    SPIN_THRESHOLD = 2
+    SPIN_PARK = 0.05
+    SPIN_OPS = frozenset(("nop", "cpuid", "copy", "not_", "loadw", "loadb",
+                          "loadwr", "loadbr", "loadwi", "loadbi") +
+                         tuple(Translator.ARITH) + tuple(Translator.LOGIC))
+
+    def __init__(self, memory, core_id=0):
         self.memory = memory
+        self.core_id = core_id
         self.registers = RegisterFile(self)
         self.cpu_lock = RLock()
         self.threads = []
+        self.thread_wakers = []
         self.exit_event = Event()
         self.trap_event = Event()
+
+        # Set by devices, delivered by the CPU between instructions
         self.intr_pending = False
+        self.preempt = False
+        self.waiting = False
+        self.spinning = False
+
+        # Instructions run so far
+        self.instructions = 0
+        self.halted = False
+
+        # run() stops before running any of these addresses
+        self.breakpoints = set()
+        self.wake_event = Event()
+
+        # Called wherever the events above are set, so Machine.run_async()
+        # can resume a parked guest
+        self.wakeup = None
         self.mmu = MMU(self.memory, self)
 
-    def register_thread(self, thread):
+        # Predecoded instructions, keyed by PC
+        self.decode_cache = {}
+        self.decode_lines = defaultdict(list)
+        self.memory.add_code_watcher(self.invalidate_code)
+
+        # Fused instruction sequences, keyed by PC, and how often each ran
+        self.fusion_sites = {}
+        self.fusion_counts = Counter()
+
+        # Basic block translations, used by execute_block()
+        self.translator = Translator(self)
+
+        # Polling loops by head PC: [pointer registers, reads fixed MMIO,
+        # last registers, unchanged iterations], or None if not one
+        self.spin_loops = {}
+
+    def register_thread(self, thread, wake=None):
+        # wake, if given, gets the thread to notice exit_event promptly
         self.threads.append(thread)
+        if wake is not None:
+            self.thread_wakers.append(wake)
 
     def end_threads(self):
         self.exit_event.set()
+        for wake in self.thread_wakers:
+            wake()
+
         for thread in self.threads:
             thread.join(timeout=1)
 
     def trap(self, addr):
         self.trap_event.set()
+        self.waiting = False
 
         with self.cpu_lock:
-            self.registers.intr_old_bit = self.registers.intr_prev_bit
-            self.registers.intr_prev_bit = self.registers.intr_bit
-            self.registers.intr_bit = 0
-
-            self.registers.user_old_bit = self.registers.user_prev_bit
-            self.registers.user_prev_bit = self.registers.user_bit
-            self.registers.user_bit = 0
+            self.registers.push_mode()
 
             self.registers[RegisterName.REG_FC] += 1
             if self.registers[RegisterName.REG_FC] == 2:
@@ -256,10 +340,7 @@ class CPU:
             self.trap(self.TRAP_ILL)
             return
 
-        self.registers[reg1] = (self.mmu.get_address(addr, mask)  << 24)
-        self.registers[reg1] |= (self.mmu.get_address(addr + 1, mask) << 16)
-        self.registers[reg1] |= (self.mmu.get_address(addr + 2, mask) << 8)
-        self.registers[reg1] |= self.mmu.get_address(addr + 3, mask)
+        self.registers[reg1] = self.mmu.get_word(addr, mask)
 
     def loadwr(self, reg1, reg2):
         self.loadw(reg1, self.registers[reg2])
@@ -273,10 +354,7 @@ class CPU:
             self.trap(self.TRAP_ILL)
             return
 
-        self.mmu.write_address(addr, (self.registers[reg1] >> 24) & 0xff)
-        self.mmu.write_address(addr + 1, (self.registers[reg1] >> 16) & 0xff)
-        self.mmu.write_address(addr + 2, (self.registers[reg1] >> 8) & 0xff)
-        self.mmu.write_address(addr + 3, (self.registers[reg1]) & 0xff)
+        self.mmu.write_word(addr, self.registers[reg1])
         self.mmu.clear_cache()
 
     def savewr(self, reg1, reg2):
@@ -316,9 +394,28 @@ class CPU:
         pass
 
     def halt(self):
-        print(self.registers.pretty_format())
-        self.end_threads()
-        quit()
+        # Caught in run(), which stops the CPU
+        raise HaltException()
+
+    def raise_interrupt(self):
+        # Called from the devices' loop; the CPU picks this up at the next
+        # instruction boundary.
+        self.intr_pending = True
+        self.preempt = True
+        if self.registers.intr_bit:
+            # Only wake a waiting CPU for an interrupt it can take; a masked
+            # one stays pending until the guest unmasks it
+            self.trap_event.set()
+        self.wake_event.set()
+        if self.wakeup is not None:
+            self.wakeup()
+
+    def device_changed(self):
+        # Called from the devices' loop when a register changes by itself,
+        # so a parked polling loop gets to see it
+        self.wake_event.set()
+        if self.wakeup is not None:
+            self.wakeup()
 
     def intr(self):
         if not self.registers.intr_bit:
@@ -328,23 +425,36 @@ class CPU:
             self.trap(self.TRAP_INTR)
 
     def rfe(self):
-        self.registers.intr_bit = self.registers.intr_prev_bit
-        self.registers.intr_prev_bit = self.registers.intr_old_bit
-
-        self.registers.user_bit = self.registers.user_prev_bit
-        self.registers.user_prev_bit = self.registers.user_old_bit
+        self.registers.pop_mode()
 
         if self.registers[RegisterName.REG_FC] > 0:
             self.registers[RegisterName.REG_FC] -= 1
 
-        if self.intr_pending and self.registers.intr_bit:
-            # Execute any pending interrupts
-            self.intr()
-
+        # Any pending interrupt is taken after this instruction
         self.registers[RegisterName.REG_PC] = self.registers[RegisterName.REG_RET]
 
+    def syscall(self):
+        # Like a trap, but without the fault counter or the trap vectors, and
+        # no lock or events since nothing else can be going on
+        r = self.registers.registers
+        self.registers.push_mode()
+        r[RegisterName.REG_RET] = r[RegisterName.REG_PC]
+        r[RegisterName.REG_PC] = r[RegisterName.REG_SYSVEC]
+
+    def sysret(self):
+        self.registers.check_privilege()
+        self.registers.pop_mode()
+
+        r = self.registers.registers
+        r[RegisterName.REG_PC] = r[RegisterName.REG_RET]
+
     def wait(self):
-        self.trap_event.wait()
+        # The CPU parks once it has released its lock, see run(). An
+        # interrupt that came in before the guest masked them can't be taken,
+        # so it mustn't wake us.
+        if not self.registers.intr_bit:
+            self.trap_event.clear()
+        self.waiting = True
 
     def swap(self, reg1, reg2):
         temp = self.registers[reg1]
@@ -388,7 +498,8 @@ class CPU:
         self.registers[reg2] = self.registers[reg1] >> val
 
     def cpuid(self):
-        self.registers[RegisterName.REG_RES] = self.CPU_VERSION
+        # Core number in the high half, so core 0 reads just the version
+        self.registers[RegisterName.REG_RES] = self.CPU_VERSION | (self.core_id << 16)
 
     def strapr(self, reg1, addr):
         trap = self.registers[reg1]
@@ -482,63 +593,406 @@ class CPU:
         ((IA_NONE,  IA_NONE,  IA_NONE),  cpuid),    # 0x44
         ((IA_REG,   IA_ADDR,  IA_NONE),  strapr),   # 0x45
         ((IA_IMMED, IA_ADDR,  IA_NONE),  strapi),   # 0x46
+        ((IA_NONE,  IA_NONE,  IA_NONE),  syscall),  # 0x47
+        ((IA_NONE,  IA_NONE,  IA_NONE),  sysret),   # 0x48
     ]
 
-    def decode_next_instr(self):
+    def decode(self, pc):
+        # Each instruction is four words
+        self.loadw(RegisterName.REG_RSVD, pc, PTEAccess.PTE_READ | PTEAccess.PTE_EXECUTE)
+        opcode = self.registers.rsvd
+        self.loadw(RegisterName.REG_RSVD, pc + 4, PTEAccess.PTE_READ | PTEAccess.PTE_EXECUTE)
+        op1 = self.registers.rsvd
+        self.loadw(RegisterName.REG_RSVD, pc + 8, PTEAccess.PTE_READ | PTEAccess.PTE_EXECUTE)
+        op2 = self.registers.rsvd
+        self.loadw(RegisterName.REG_RSVD, pc + 12, PTEAccess.PTE_READ | PTEAccess.PTE_EXECUTE)
+        op3 = self.registers.rsvd
+
+        if opcode >= len(self.INSTRS):
+            # Invalid opcode
+            print("Error: Invalid opcode", hex(opcode))
+            self.registers[RegisterName.REG_PC] = pc + 16
+            self.trap(self.TRAP_ILL)
+            return None
+
+        # This type checks the arguments and adds the argument to the arg list
+        # This makes the instruction specification more flexible
+        arglist = []
+        privileged = False
+        instr_type, instr_fn = self.INSTRS[opcode]
+        #print(hex(pc), instr_fn.__name__, hex(op1), hex(op2), hex(op3))
+        for (argtype, arg) in zip(instr_type, (op1, op2, op3)):
+            # Type check the argument
+            if argtype == self.IA_NONE:
+                continue
+            elif argtype == self.IA_REG:
+                if arg in self.registers.DIS_REGS:
+                    print("Bad register", hex(arg))
+                    self.registers[RegisterName.REG_PC] = pc + 16
+                    self.trap(self.TRAP_ILL)
+                    return None
+
+                privileged = privileged or arg in self.registers.PRIV_REGS
+
+            arglist.append(arg)
+
+        handler = MethodType(instr_fn, self)
+        if privileged:
+            handler = self._privileged(handler)
+
+        entry = (handler, tuple(arglist))
+
+        # Only cache code in RAM; device memory (such as the interrupt
+        # controller's jmp stub) can change under us without a write.
+        if not self.registers.mmu_bit and not self.memory.is_mmio(pc, 16):
+            if instr_fn.__name__ in self.FUSION_HEADS:
+                entry = (self._fusion_probe(pc, entry[0]), entry[1])
+
+            target = self._static_branch(instr_fn.__name__, arglist)
+            if target is not None and target <= pc:
+                loop = self.spin_loop(target)
+                if loop is not None and loop[0] == pc:
+                    entry = (self._spin_probe(target, entry[0]), entry[1])
+
+            self.cache_entry(pc, entry, 16)
+
+        return entry
+
+    def cache_entry(self, pc, entry, length):
+        self.decode_cache[pc] = entry
+        self.watch_lines(pc, length)
+
+    def watch_lines(self, pc, length):
+        # Drop what we know about the code at pc when it's overwritten
+        for line in self.memory.lines_of(pc, length):
+            self.decode_lines[line].append(pc)
+
+        self.memory.watch_code(pc, length)
+
+    def invalidate_code(self, line):
+        for pc in self.decode_lines.pop(line, ()):
+            self.decode_cache.pop(pc, None)
+            self.fusion_sites.pop(pc, None)
+            self.spin_loops.pop(pc, None)
+
+    def flush_code(self):
+        # Forget all cached code, for when memory changed behind our back
+        for line in list(self.decode_lines):
+            self.invalidate_code(line)
+
+        for line in list(self.translator.block_lines):
+            self.translator.invalidate_code(line)
+
+    @staticmethod
+    def _static_branch(name, args):
+        # Target of a jump whose target is fixed, else None
+        if name == "jmp":
+            return args[0]
+        elif name.startswith("jmp") and name[3:5] in Translator.CONDITIONS and name[5:] in ("", "i"):
+            return args[2]
+
+        return None
+
+    def spin_loop(self, head):
+        # Work out if head is the top of a short loop that only reads memory
+        # and computes on registers, up to the first branch back to head
+        if head in self.spin_loops:
+            return self.spin_loops[head]
+
+        loop = None
+        pointers = []
+        mmio = False
+        for addr in range(head, head + (self.SPIN_MAX * 16), 16):
+            instr = self.translator.fetch(addr)
+            if instr is None:
+                break
+
+            name, args = instr
+            target = self._static_branch(name, args)
+            if target == head:
+                if mmio or pointers:
+                    loop = [addr, pointers, mmio, None, 0]
+
+                break
+            elif name in ("loadw", "loadb"):
+                mmio = mmio or self.memory.is_mmio(args[1])
+            elif name in ("loadwr", "loadbr"):
+                pointers.append(args[1])
+            elif name not in self.SPIN_OPS and target is None:
+                break
+
+        self.spin_loops[head] = loop
+        self.watch_lines(head, addr + 16 - head)
+        return loop
+
+    def spin_check(self, head):
+        loop = self.spin_loops.get(head)
+        if loop is None:
+            return
+
+        regs = tuple(self.registers.registers)
+        if regs != loop[3]:
+            loop[3] = regs
+            loop[4] = 0
+            return
+
+        loop[4] += 1
+        if loop[4] >= self.SPIN_THRESHOLD:
+            # Only device registers can change under a loop like this
+            pointers, mmio = loop[1], loop[2]
+            if mmio or any(self.memory.is_mmio(regs[reg]) for reg in pointers):
+                self.spinning = True
+
+    def _spin_probe(self, head, handler):
+        # Wraps the backward branch of a polling loop
+        def probe(*args):
+            handler(*args)
+            if self.registers[RegisterName.REG_PC] == head:
+                self.spin_check(head)
+
+        return probe
+
+    def _privileged(self, handler):
+        # Only instructions naming a privileged register need the mode check
+        check = self.registers.check_privilege
+
+        def checked(*args):
+            check()
+            handler(*args)
+
+        return checked
+
+    def _fusion_probe(self, pc, handler):
+        # Stands in for a possible fusion head until it gets hot
+        hits = 0
+
+        def probe(*args):
+            nonlocal hits
+            hits += 1
+            if hits == self.FUSION_THRESHOLD:
+                self.fuse(pc)
+
+            handler(*args)
+
+        return probe
+
+    def fuse(self, pc):
+        names = []
+        parts = []
+        for addr in range(pc, pc + (self.FUSION_MAX * 16), 16):
+            instr = self.translator.fetch(addr)
+            if instr is None:
+                break
+
+            handler = getattr(self, instr[0])
+            if self.translator.privileged(*instr):
+                handler = self._privileged(handler)
+
+            names.append(instr[0])
+            parts.append((handler, instr[1]))
+
+        for fusion in self.FUSIONS:
+            if tuple(names[:len(fusion)]) == fusion:
+                break
+        else:
+            return
+
+        if any(pc + (i * 16) in self.breakpoints for i in range(1, len(fusion))):
+            # Leave it unfused so we can stop inside it
+            return
+
+        parts = parts[:len(fusion)]
+        registers = self.registers
+        counts = self.fusion_counts
+
+        def fused(limit=len(parts)):
+            # The PC is stepped between parts just as the interpreter would,
+            # so a fault in any part traps at that part. Runs at most limit
+            # parts and returns how many ran, faulting one included, as
+            # step() counts it.
+            ran = 0
+            for i, (handler, args) in enumerate(parts[:limit]):
+                if i:
+                    if registers[RegisterName.REG_PC] != pc + (i * 16):
+                        # Branched or trapped
+                        break
+
+                    registers[RegisterName.REG_PC] = pc + ((i + 1) * 16)
+
+                ran += 1
+                try:
+                    handler(*args)
+                except (PageFaultException, InvalidBasePointerException,
+                        PrivilegeException) as e:
+                    self.fault(e)
+                    break
+
+            counts[fusion] += 1
+            return ran
+
+        self.fusion_sites[pc] = fusion
+        self.cache_entry(pc, (fused, ()), len(fusion) * 16)
+
+    def add_breakpoint(self, pc):
+        self.breakpoints.add(pc)
+
+        # Break up fused sequences that run over it
+        for site, fusion in list(self.fusion_sites.items()):
+            if site < pc < site + (len(fusion) * 16):
+                del self.fusion_sites[site]
+                self.decode_cache.pop(site, None)
+
+    def remove_breakpoint(self, pc):
+        self.breakpoints.discard(pc)
+
+    def fusion_report(self):
+        # [(fused instructions, times run, sites currently fused)], busiest first
+        sites = Counter(self.fusion_sites.values())
+        report = [(fusion, count, sites[fusion])
+                  for fusion, count in self.fusion_counts.items()]
+        return sorted(report, key=lambda x: x[1], reverse=True)
+
+    def fault(self, e):
+        # Rewind to the faulting instruction and trap
+        self.registers[RegisterName.REG_PC] -= 16  # Retry instruction
+        if isinstance(e, PageFaultException):
+            self.registers[RegisterName.REG_VADDR] = e.addr
+            self.trap(self.TRAP_PFAULT)
+        elif isinstance(e, InvalidBasePointerException):
+            self.trap(self.TRAP_BBPTR)
+        else:
+            self.trap(self.TRAP_ILL)
+
+    def step(self, budget=None):
+        # Run the next instruction, or a fused sequence of no more than budget
+        # instructions if given; returns how many ran
+        # Pending interrupts are taken before the next instruction
+        if self.intr_pending and self.registers.intr_bit:
+            self.intr()
+
+        pc = self.registers[RegisterName.REG_PC]
+        entry = None
+        if not self.registers.mmu_bit:
+            entry = self.decode_cache.get(pc)
+            if budget is not None and budget < self.FUSION_MAX and \
+                    entry is not None and pc in self.fusion_sites:
+                # Only run as much of the sequence as there's budget for
+                entry = (entry[0], (budget,))
+
+        if entry is None:
+            entry = self.decode(pc)
+            if entry is None:
+                # Trapped during decode
+                return 1
+
+        handler, arglist = entry
+        self.registers[RegisterName.REG_PC] = pc + 16
+
+        try:
+            ran = handler(*arglist)
+        except (PageFaultException, InvalidBasePointerException, PrivilegeException) as e:
+            self.fault(e)
+            return 1
+
+        # Only fused sequences say how many they ran
+        return 1 if ran is None else ran
+
+    def step_block(self, budget=None):
+        # Run the next block, unless it's longer than budget; returns how many
+        # instructions ran
+        if self.intr_pending and self.registers.intr_bit:
+            self.intr()
+
+        block = None
+        if not self.registers.mmu_bit:
+            block = self.translator.lookup(self.registers[RegisterName.REG_PC])
+
+        if block is None or (budget is not None and budget < block[1]):
+            # Not translatable or too long, interpret it
+            return self.step(budget)
+
+        pc = self.registers[RegisterName.REG_PC]
+        try:
+            count = block[0](self)
+        except (PageFaultException, InvalidBasePointerException, PrivilegeException) as e:
+            # Blocks step the PC past each instruction they hand off, so it
+            # says how far we got; the faulting one counts, as in step()
+            count = (self.registers[RegisterName.REG_PC] - pc) >> 4
+            self.fault(e)
+            return count
+        except HaltException as e:
+            e.ran = ((self.registers[RegisterName.REG_PC] - pc) >> 4) - 1
+            raise
+
+        if self.registers[RegisterName.REG_PC] == pc and self.spin_loop(pc) is not None:
+            # A block that loops on itself, see spin_loop()
+            self.spin_check(pc)
+
+        return count
+
+    def run(self, quantum, translate=False, park=True, limit=None):
+        # Run up to quantum instructions under one hold of the lock. We stop
+        # early when the guest waits or a device raises an interrupt, so
+        # the devices get their turn, or when we reach a breakpoint.
+        # With park false we return instead of blocking when the guest waits
+        # or spins, leaving waiting/spinning set for the caller to deal with.
+        # Translated blocks and fused sequences may run a little past quantum,
+        # but never past limit instructions if it's given.
+        if self.halted:
+            return 0
+
+        if self.breakpoints:
+            # Translated blocks and fused sequences would run past them
+            translate = False
+
         sleep(0)
+        executed = 0
+        breakpoints = self.breakpoints
         with self.cpu_lock:
-            # Each instruction is four words
-            self.loadw(RegisterName.REG_RSVD, self.registers[RegisterName.REG_PC],
-                       PTEAccess.PTE_READ | PTEAccess.PTE_EXECUTE)
-            opcode = self.registers.rsvd
-            self.registers[RegisterName.REG_PC] += 4
-
-            self.loadw(RegisterName.REG_RSVD, self.registers[RegisterName.REG_PC],
-                       PTEAccess.PTE_READ | PTEAccess.PTE_EXECUTE)
-            op1 = self.registers.rsvd
-            self.registers[RegisterName.REG_PC] += 4
-
-            self.loadw(RegisterName.REG_RSVD, self.registers[RegisterName.REG_PC],
-                       PTEAccess.PTE_READ | PTEAccess.PTE_EXECUTE)
-            op2 = self.registers.rsvd
-            self.registers[RegisterName.REG_PC] += 4
-
-            self.loadw(RegisterName.REG_RSVD, self.registers[RegisterName.REG_PC],
-                       PTEAccess.PTE_READ | PTEAccess.PTE_EXECUTE)
-            op3 = self.registers.rsvd
-            self.registers[RegisterName.REG_PC] += 4
-
-            if opcode >= len(self.INSTRS):
-                # Invalid opcode
-                print("Error: Invalid opcode", hex(opcode))
-                self.trap(self.TRAP_ILL)
-                return
+            try:
+                while executed < quantum:
+                    budget = None if limit is None else limit - executed
+                    if translate:
+                        executed += self.step_block(budget)
+                    else:
+                        executed += self.step(budget)
+
+                    if self.waiting or self.preempt or self.spinning:
+                        break
+
+                    if breakpoints and self.registers[RegisterName.REG_PC] in breakpoints:
+                        break
+            except HaltException as e:
+                executed += e.ran
+                self.halted = True
+            finally:
+                # Still counted when the guest halts
+                self.instructions += executed
+
+            self.preempt = False
+
+        if self.halted:
+            self.end_threads()
+        elif park:
+            self.park()
+
+        return executed
+
+    def park(self):
+        # Block outside the lock until a device gives a waiting or polling
+        # guest something to do
+        if self.waiting:
+            # Until a device raises an interrupt
+            self.trap_event.wait()
+            self.waiting = False
+        elif self.spinning:
+            # Polling loop; nothing can change until a device does
+            self.wake_event.wait(self.SPIN_PARK)
+            self.wake_event.clear()
+            self.spinning = False
 
-            # This type checks the arguments and adds the argument to the arg list
-            # This makes the instruction specification more flexible
-            arglist = []
-            instr_type, instr_fn = self.INSTRS[opcode]
-            #print(hex(self.registers[RegisterName.REG_PC] - 16), instr_fn.__name__, hex(op1), hex(op2), hex(op3))
-            for (argtype, arg) in zip(instr_type, (op1, op2, op3)):
-                # Type check the argument
-                if argtype == self.IA_NONE:
-                    continue
-                elif argtype == self.IA_REG:
-                    if arg in self.registers.DIS_REGS:
-                        print("Bad register", hex(arg))
-                        return self.trap(self.TRAP_ILL)
-
-                arglist.append(arg)
+    def decode_next_instr(self):
+        self.run(1)
 
-            try:
-                instr_fn(self, *arglist)
-            except PageFaultException as e:
-                self.registers[RegisterName.REG_VADDR] = e.addr
-                self.registers[RegisterName.REG_PC] -= 16  # Retry instruction
-                self.trap(self.TRAP_PFAULT)
-            except InvalidBasePointerException:
-                self.registers[RegisterName.REG_PC] -= 16  # Retry instruction
-                self.trap(self.TRAP_BBPTR)
-            except PrivilegeException:
-                self.registers[RegisterName.REG_PC] -= 16  # Retry instruction
-                self.trap(self.TRAP_ILL)
+    def execute_block(self):
+        self.run(1, translate=True)
@@ -0,0 +1,284 @@
+from . import reactor
+from .hardware import Hardware
+from threading import Event
+import mmap
+import multiprocessing
+import os
+import select
+import struct
+import time
+import traceback
+
+
+# Messages. Requests go from the CPU to the device process, replies back to
+# the CPU thread, and events back to the CPU's device loop.
+OP_READ = 1
+OP_WRITE = 2
+OP_READ_WORD = 3
+OP_WRITE_WORD = 4
+OP_CONTROL = 5
+OP_STOP = 6
+OP_REPLY = 7
+OP_ERROR = 8
+OP_INTERRUPT = 9
+OP_CHANGED = 10
+
+
+class Ring:
+    # A single-producer, single-consumer queue of fixed-size messages in
+    # memory shared with the forked device process. The producer only moves
+    # head and the consumer only moves tail, so neither takes a lock. Every
+    # put also writes a byte to a pipe for the consumer to wait on.
+    SLOT = struct.Struct("<BBxxII")  # op, device, item, value
+    INDEX = struct.Struct("<Q")
+
+    # Each index on its own cache line
+    HEAD = 0
+    TAIL = 64
+    SLOTS = 128
+
+    def __init__(self, slots=4096):
+        self.slots = slots
+        self.buf = mmap.mmap(-1, self.SLOTS + slots * self.SLOT.size)
+
+        self.recv_fd, self.send_fd = os.pipe()
+        os.set_blocking(self.recv_fd, False)
+        os.set_blocking(self.send_fd, False)
+
+    def _get(self, index):
+        return self.INDEX.unpack_from(self.buf, index)[0]
+
+    def _set(self, index, value):
+        self.INDEX.pack_into(self.buf, index, value)
+
+    def put(self, op, device=0, item=0, value=0):
+        head = self._get(self.HEAD)
+        while head - self._get(self.TAIL) >= self.slots:
+            # Full, let the consumer catch up
+            time.sleep(0.0001)
+
+        self.SLOT.pack_into(self.buf, self.SLOTS + (head % self.slots) * self.SLOT.size,
+                            op, device, item, value & 0xffffffff)
+        self._set(self.HEAD, head + 1)
+
+        # Always, rather than only for a consumer that says it's asleep: that
+        # needs our store to head ordered before our load of its flag, which
+        # the host doesn't promise. The pipe is ordered by the kernel, so a
+        # consumer that reads it sees head as it was when we wrote.
+        try:
+            os.write(self.send_fd, b"\0")
+        except BlockingIOError:
+            # Plenty of wakeups queued already
+            pass
+
+    def get(self):
+        tail = self._get(self.TAIL)
+        if tail == self._get(self.HEAD):
+            return None
+
+        message = self.SLOT.unpack_from(self.buf, self.SLOTS + (tail % self.slots) * self.SLOT.size)
+        self._set(self.TAIL, tail + 1)
+        return message
+
+    def woken(self):
+        # Before looking at the ring; anything put after this wakes us again
+        try:
+            while os.read(self.recv_fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def drain(self):
+        # Everything queued
+        self.woken()
+        while True:
+            message = self.get()
+            if message is None:
+                return
+            yield message
+
+
+class _Link:
+    # Stands in for the CPU and interrupt controller in the device process,
+    # passing interrupts and changes back over the events ring
+    def __init__(self, events):
+        self.events = events
+        self.exit_event = Event()
+
+    def register_thread(self, thread, wake=None):
+        pass
+
+    def device_changed(self):
+        self.events.put(OP_CHANGED)
+
+    def interrupt(self, num):
+        self.events.put(OP_INTERRUPT, value=num)
+
+
+class RemoteDevice(Hardware):
+    # Takes the place of a device run by a DeviceHost. Writes are posted and
+    # the CPU carries on; a read waits for every write before it to land,
+    # so the guest sees the same registers as with the device in-process.
+    def __init__(self, cpu, memory, host, index, cls):
+        super().__init__(cpu, memory)
+        self.host = host
+        self.index = index
+        self.name = cls.__name__
+        self.ADDR_BEGIN = cls.ADDR_BEGIN
+        self.ADDR_END = cls.ADDR_END
+
+    def save_state(self):
+        return self.host.control(self.index, "save_state")
+
+    def load_state(self, state):
+        self.host.control(self.index, "load_state", state)
+
+    def read_word(self, item):
+        return self.host.read(self.index, item, OP_READ_WORD)
+
+    def write_word(self, item, val):
+        self.host.requests.put(OP_WRITE_WORD, self.index, item, val)
+
+    def __getitem__(self, item):
+        return self.host.read(self.index, item)
+
+    def __setitem__(self, item, val):
+        self.host.requests.put(OP_WRITE, self.index, item, val)
+
+
+class DeviceHost:
+    # Runs some of a machine's devices in a forked process of their own, on
+    # its own reactor, so their syscalls and Python code don't hold up the
+    # CPU. The interrupt controller stays with the CPU.
+
+    # Longest we wait on the device process before checking it's alive
+    WAIT = 0.1
+
+    def __init__(self, cpu, build):
+        # build(name, cpu, intc) makes a device, in the device process
+        self.cpu = cpu
+        self.build = build
+        self.intc = None
+        self.names = []
+
+        self.requests = Ring()
+        self.replies = Ring()
+        self.events = Ring()
+        self.control_conn = None
+
+        self.process = None
+        self.loop = None
+
+    def add(self, name, cls, memory):
+        self.names.append(name)
+        return RemoteDevice(self.cpu, memory, self, len(self.names) - 1, cls)
+
+    def start(self, intc):
+        self.intc = intc
+
+        ctx = multiprocessing.get_context("fork")
+        self.control_conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=self._host_main, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+        self.cpu.register_thread(self.process, self.stop)
+
+    def stop(self):
+        self.requests.put(OP_STOP)
+
+    def read(self, index, item, op=OP_READ):
+        self.requests.put(op, index, item)
+
+        replies = self.replies
+        while True:
+            message = replies.get()
+            if message is not None:
+                break
+
+            select.select([replies.recv_fd], [], [], self.WAIT)
+            replies.woken()
+            if not self.process.is_alive():
+                raise RuntimeError("Device process has exited")
+
+        op, _, _, value = message
+        if op == OP_ERROR:
+            raise RuntimeError(f"{self.names[index]} failed in the device process")
+
+        return value
+
+    def control(self, index, method, *args):
+        # Call a method of the real device, in order with the guest's I/O
+        self.requests.put(OP_CONTROL, index)
+        self.control_conn.send((method, args))
+        result = self.control_conn.recv()
+        if isinstance(result, Exception):
+            raise result
+
+        return result
+
+    # The CPU's side of the events ring, on its device loop
+
+    def attach_loop(self, loop):
+        self.loop = loop
+        loop.add_reader(self.events.recv_fd, self._events)
+
+    def detach_loop(self):
+        self.loop.remove_reader(self.events.recv_fd)
+        self.loop = None
+
+    def _events(self):
+        for op, _, _, value in self.events.drain():
+            if op == OP_INTERRUPT:
+                self.intc.interrupt(value)
+            elif op == OP_CHANGED:
+                self.cpu.device_changed()
+
+    # The device process
+
+    def _host_main(self, conn):
+        link = _Link(self.events)
+        devices = [self.build(name, link, link) for name in self.names]
+
+        loop = reactor.Reactor(link)
+        for device in devices:
+            loop.attach(device)
+
+        def serve():
+            for op, index, item, value in self.requests.drain():
+                if op == OP_STOP:
+                    loop.stopping = True
+                    return
+
+                device = devices[index]
+                if op == OP_WRITE:
+                    try:
+                        device[item] = value
+                    except Exception:
+                        traceback.print_exc()
+                elif op == OP_WRITE_WORD:
+                    try:
+                        device.write_word(item, value)
+                    except Exception:
+                        traceback.print_exc()
+                elif op in (OP_READ, OP_READ_WORD):
+                    try:
+                        if op == OP_READ:
+                            value = device[item]
+                        else:
+                            value = device.read_word(item)
+                        self.replies.put(OP_REPLY, value=value)
+                    except Exception:
+                        traceback.print_exc()
+                        self.replies.put(OP_ERROR)
+                elif op == OP_CONTROL:
+                    method, args = conn.recv()
+                    try:
+                        result = getattr(device, method)(*args)
+                    except Exception as e:
+                        result = e
+                    conn.send(result)
+
+        loop.add_reader(self.requests.recv_fd, serve)
+        loop.start()
+        loop.thread.join()
@@ -0,0 +1,127 @@
+from . import machine
+from .register import RegisterName
+from contextlib import redirect_stdout
+from functools import partial
+from multiprocessing import Pool
+import io
+import os
+import time
+
+
+class Job:
+    def __init__(self, image, storage_file=None, input_data=b"",
+                 max_instructions=None, timeout=None, translate=False, name=None,
+                 devices=None):
+        self.image = image
+        self.storage_file = storage_file
+        self.input_data = input_data
+        self.max_instructions = max_instructions
+        self.timeout = timeout
+        self.translate = translate
+        self.name = image if name is None else name
+        self.devices = devices
+
+
+# run_until() reasons, as reported in results
+STATUS = {
+    machine.RunResult.HALT: "halted",
+    machine.RunResult.BUDGET: "budget",
+    machine.RunResult.CONDITION: "timeout",
+}
+
+
+def run_job(job, quantum=1000):
+    output = io.StringIO()
+    started = time.monotonic()
+
+    # Keep the emulator's own diagnostics out of our stdout
+    with redirect_stdout(io.StringIO()):
+        try:
+            m = machine.Machine(job.image, job.translate, job.storage_file,
+                                io.BytesIO(job.input_data), output,
+                                devices=job.devices)
+        except Exception as e:
+            return {"name": job.name, "status": "error", "error": repr(e)}
+
+    return run_machine(m, job, output, started, quantum)
+
+
+def run_machine(m, job, output, started, quantum=1000):
+    # The rest of run_job(), for a machine already set up with the job's
+    # input and printing to output
+    error = None
+
+    with redirect_stdout(io.StringIO()):
+        cpu = m.cpu
+        deadline = None
+        until = None
+        if job.timeout is not None:
+            deadline = started + job.timeout
+            until = lambda m: time.monotonic() >= deadline
+
+        try:
+            budget = job.max_instructions
+            while True:
+                result = m.run_until(budget, until=until, quantum=quantum)
+                if result.reason != machine.RunResult.WAIT:
+                    break
+
+                if budget is not None:
+                    budget -= result.instructions
+
+                # Idle guest; sleep until a device interrupts it or the
+                # deadline, which run_until() then sees
+                m.wait(None if deadline is None else max(0, deadline - time.monotonic()))
+
+            status = STATUS[result.reason]
+        except Exception as e:
+            status = "error"
+            error = repr(e)
+        finally:
+            if not cpu.halted:
+                cpu.end_threads()
+
+    registers = {RegisterName(i).name: value
+                 for i, value in enumerate(cpu.registers.registers)
+                 if i != RegisterName.REG_RSVD}
+
+    result = {
+        "name": job.name,
+        "status": status,
+        "instructions": cpu.instructions,
+        "seconds": time.monotonic() - started,
+        "registers": registers,
+        "output": output.getvalue(),
+    }
+
+    if error is not None:
+        result["error"] = error
+
+    return result
+
+
+class Fleet:
+    # Runs jobs over a pool of worker processes, one per host core by
+    # default. Workers are kept between jobs so imports and the like are
+    # only paid for once per worker.
+
+    def __init__(self, processes=None, quantum=1000):
+        if processes is None:
+            processes = os.cpu_count()
+
+        self.quantum = quantum
+        self.pool = Pool(processes)
+
+    def run(self, jobs):
+        # Yields results as jobs finish, not in the order given
+        return self.pool.imap_unordered(partial(run_job, quantum=self.quantum), jobs)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,129 @@
+from . import machine, fleet
+from contextlib import redirect_stdout
+import io
+import json
+import os
+import selectors
+import time
+import traceback
+
+
+class ForkServer:
+    # Boots one machine up to boot (an address or a label), then runs each
+    # job in a fork of it. Forks share the booted machine's memory
+    # copy-on-write, so a job only pays for what it touches, not the boot.
+    #
+    # Only the job's input, budget, timeout and name are used; the image,
+    # storage and devices are the server's. Guest sockets and storage are
+    # shared by every fork, like a pre-forking server's.
+
+    def __init__(self, image, boot, translate=False, storage_file=None,
+                 devices=None, quantum=1000):
+        self.quantum = quantum
+        self.boot_output = io.StringIO()
+
+        with redirect_stdout(io.StringIO()):
+            self.machine = machine.Machine(image, translate, storage_file,
+                                           io.BytesIO(), self.boot_output,
+                                           devices=devices)
+
+        if self.machine.device_host is not None:
+            # Every fork would share the one device process and its rings
+            self.machine.cpu.end_threads()
+            raise ValueError("Machines with remote devices can't be forked")
+
+        started = time.monotonic()
+        result = self.machine.run_until(pc=boot, quantum=quantum)
+        while result.reason == machine.RunResult.WAIT:
+            self.machine.wait()
+            result = self.machine.run_until(pc=boot, quantum=quantum)
+        if result.reason != machine.RunResult.BREAKPOINT:
+            raise RuntimeError(f"Guest didn't reach {boot}: {result!r}")
+        self.boot_seconds = time.monotonic() - started
+
+        # Threads don't survive a fork, and locks they hold would stay held
+        self.machine.stop_devices()
+
+    def _child(self, job, started):
+        m = self.machine
+        m.cpu.instructions = 0
+
+        output = io.StringIO()
+        if m.keyboard is not None:
+            m.keyboard.stream = io.BytesIO(job.input_data)
+        if m.printer is not None:
+            m.printer.output = output
+
+        m.start_devices()
+        return fleet.run_machine(m, job, output, started, self.quantum)
+
+    def _spawn(self, job):
+        started = time.monotonic()
+        read_fd, write_fd = os.pipe()
+
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            status = 0
+            try:
+                result = self._child(job, started)
+                with os.fdopen(write_fd, "w") as f:
+                    json.dump(result, f)
+            except BaseException:
+                traceback.print_exc()
+                status = 1
+            finally:
+                # Don't run the parent's cleanup, atexit and the like
+                os._exit(status)
+
+        os.close(write_fd)
+        return pid, read_fd
+
+    @staticmethod
+    def _collect(pid, job, data):
+        _, status = os.waitpid(pid, 0)
+        if data:
+            return json.loads(data)
+
+        return {"name": job.name, "status": "error",
+                "error": f"Fork exited with status {os.waitstatus_to_exitcode(status)}"}
+
+    def map(self, jobs, processes=None):
+        # Yields results as jobs finish, not in the order given, with up to
+        # processes forks running at once (one per host core by default)
+        if processes is None:
+            processes = os.cpu_count()
+
+        jobs = iter(jobs)
+        selector = selectors.DefaultSelector()
+        running = 0
+        try:
+            while True:
+                while running < processes:
+                    job = next(jobs, None)
+                    if job is None:
+                        break
+
+                    pid, fd = self._spawn(job)
+                    selector.register(fd, selectors.EVENT_READ, (pid, job, []))
+                    running += 1
+
+                if not running:
+                    return
+
+                for key, _ in selector.select():
+                    pid, job, chunks = key.data
+                    data = os.read(key.fd, 65536)
+                    if data:
+                        chunks.append(data)
+                        continue
+
+                    selector.unregister(key.fd)
+                    os.close(key.fd)
+                    running -= 1
+                    yield self._collect(pid, job, b"".join(chunks))
+        finally:
+            selector.close()
+
+    def run(self, job):
+        return next(self.map([job], 1))
@@ -2,10 +2,57 @@ class Hardware:
     ADDR_BEGIN = -1
     ADDR_END = -1
 
+    # Whether the device does anything on its loop; a machine whose devices
+    # don't needn't run one
+    USES_LOOP = False
+
     def __init__(self, cpu, memory):
         self.cpu = cpu
         self.memory = memory
 
+        # What drives the device: the machine's Reactor, or the asyncio loop
+        # under Machine.run_async()
+        self.loop = None
+
+    def attach_loop(self, loop):
+        # Called before the guest runs
+        self.loop = loop
+
+    def detach_loop(self):
+        # Called once the loop stops driving us; drop any callbacks left on it
+        self.loop = None
+
+    def save_state(self):
+        # Register contents for a snapshot, as something JSON can hold
+        return {}
+
+    def load_state(self, state):
+        pass
+
+    def changed(self):
+        # A register changed without the guest writing to it
+        self.cpu.device_changed()
+
+    # Words are big-endian, as the CPU sees them. These go through the byte
+    # registers; devices with word registers override them to skip the byte
+    # shuffling, falling back to these for anything else.
+
+    def read_word(self, item):
+        return (self[item] << 24) | (self[item + 1] << 16) | (self[item + 2] << 8) | self[item + 3]
+
+    def write_word(self, item, val):
+        self[item] = (val >> 24) & 0xff
+        self[item + 1] = (val >> 16) & 0xff
+        self[item + 2] = (val >> 8) & 0xff
+        self[item + 3] = val & 0xff
+
+    def read_range(self, item, length):
+        return bytearray(self[i] for i in range(item, item + length))
+
+    def write_range(self, item, data):
+        for i, val in enumerate(data):
+            self[item + i] = val
+
     def __getitem__(self, item):
         raise NotImplementedError()
 
@@ -1,7 +1,7 @@
 from . import Hardware
 from ..util import set_word_byte, get_word_byte, in_range
 
-from threading import Thread, Event, Lock
+from threading import Event, Lock
 from queue import Queue
 
 
@@ -20,6 +20,8 @@ class InterruptController(Hardware):
     ADDR_BEGIN = 0xffffefce
     ADDR_END = 0xffffeffe
 
+    USES_LOOP = True
+
     INTC_MASK = 0x0        # 0xffffefce
     INTC_REG_INTNUM = 0x4  # 0xffffefd2
     INTC_REG_INTVEC = 0x8  # 0xffffefd6
@@ -28,6 +30,10 @@ class InterruptController(Hardware):
     INTC_GET_INT = 0x14    # 0xffffefe2
     INTC_TRIGGER = 0x18    # 0xffffefe6
     INTC_JMP_INSTR = 0x1c  # 0xffffefea
+    INTC_IPI = 0x2c        # 0xffffeffa
+
+    # Interrupt raised by an inter-processor interrupt
+    INT_IPI = 16
 
     def __init__(self, cpu, memory):
         super().__init__(cpu, memory)
@@ -35,6 +41,10 @@ class InterruptController(Hardware):
         # Registers
         self.reg_intnum = 0
         self.reg_intvec = 0
+        self.reg_ipi = 0
+
+        # Delivers an IPI to another core; set up by SMPMachine
+        self.ipi_sender = None
 
         # Internal interrupt state
         self.interrupts = {}
@@ -43,28 +53,53 @@ class InterruptController(Hardware):
         self.unmasked = Event()
         self.interrupt_lock = Lock()
 
-        self.pp_task = Thread(target=self.process_pending, daemon=True)
-        self.pp_task.start()
-
-        self.cpu.register_thread(self.pp_task)
-
-    def process_pending(self):
-        while not self.cpu.exit_event.is_set():
-            interrupt = self.pending.get()
-
-            self.unmasked.wait()
-            if not self.unmasked.is_set():
-                # Spurious wakeup
-                continue
+    def attach_loop(self, loop):
+        super().attach_loop(loop)
+        loop.call_soon(self.deliver_pending)
 
+    def deliver_pending(self):
+        # Run on the loop whenever an interrupt is queued or interrupts are
+        # unmasked
+        while self.unmasked.is_set() and not self.pending.empty():
             # Mask all further interrupts to avoid races
             # Callee must unmask interrupts manually
             self.unmasked.clear()
 
-            self.interrupt_nowait(interrupt)
+            self.interrupt_nowait(self.pending.get_nowait())
+
+    def save_state(self):
+        return {
+            "reg_intnum": self.reg_intnum,
+            "reg_intvec": self.reg_intvec,
+            "reg_ipi": self.reg_ipi,
+            "interrupts": list(self.interrupts.items()),
+            "current": self.current,
+            "pending": list(self.pending.queue),
+            "unmasked": self.unmasked.is_set(),
+        }
+
+    def load_state(self, state):
+        with self.interrupt_lock:
+            self.reg_intnum = state["reg_intnum"]
+            self.reg_intvec = state["reg_intvec"]
+            self.reg_ipi = state["reg_ipi"]
+            self.interrupts = dict(state["interrupts"])
+            self.current = state["current"]
+            self.unmasked.set() if state["unmasked"] else self.unmasked.clear()
+
+        for int_num in state["pending"]:
+            self.interrupt(int_num)
 
     def interrupt(self, int_num):
         self.pending.put(int_num)
+        if self.loop is not None:
+            self.loop.call_soon(self.deliver_pending)
+
+    def send_ipi(self, core_id):
+        if core_id == self.cpu.core_id:
+            self.interrupt(self.INT_IPI)
+        elif self.ipi_sender is not None:
+            self.ipi_sender(core_id)
 
     def interrupt_nowait(self, int_num):
         with self.interrupt_lock:
@@ -74,7 +109,47 @@ class InterruptController(Hardware):
 
             self.current = self.interrupts[int_num]
             # If our interrupt handler is registered, then we're golden.
-            self.cpu.intr()
+            self.cpu.raise_interrupt()
+
+    def read_word(self, item):
+        with self.interrupt_lock:
+            if item == self.INTC_MASK:
+                return int(not self.unmasked.is_set())
+            elif item == self.INTC_REG_INTNUM:
+                return self.reg_intnum
+            elif item == self.INTC_REG_INTVEC:
+                return self.reg_intvec
+            elif item == self.INTC_IPI:
+                return self.reg_ipi
+            elif item == self.INTC_JMP_INSTR:
+                return 0x19
+            elif item == self.INTC_JMP_INSTR + 4:
+                return self.current
+
+        return super().read_word(item)
+
+    def write_word(self, item, val):
+        # The command registers act on every non-zero byte, so they go
+        # through the bytes
+        with self.interrupt_lock:
+            if item == self.INTC_MASK:
+                # Each byte sets it, so the last one wins
+                self.unmasked.set() if not val & 0xff else self.unmasked.clear()
+                if self.loop is not None and self.unmasked.is_set():
+                    self.loop.call_soon(self.deliver_pending)
+                return
+            elif item == self.INTC_REG_INTNUM:
+                self.reg_intnum = val
+                return
+            elif item == self.INTC_REG_INTVEC:
+                self.reg_intvec = val
+                return
+            elif item == self.INTC_IPI:
+                self.reg_ipi = val
+                self.send_ipi(self.reg_ipi)
+                return
+
+        super().write_word(item, val)
 
     def __getitem__(self, item):
         with self.interrupt_lock:
@@ -84,6 +159,8 @@ class InterruptController(Hardware):
                 return get_word_byte(self.reg_intnum, item - self.INTC_REG_INTNUM)
             elif in_range(item, self.INTC_REG_INTVEC, self.INTC_REG_INTVEC + 3):
                 return get_word_byte(self.reg_intvec, item - self.INTC_REG_INTVEC)
+            elif in_range(item, self.INTC_IPI, self.INTC_IPI + 3):
+                return get_word_byte(self.reg_ipi, item - self.INTC_IPI)
             elif item == self.INTC_JMP_INSTR + 3:
                 # jmp opcode
                 return 0x19
@@ -97,6 +174,8 @@ class InterruptController(Hardware):
         with self.interrupt_lock:
             if in_range(item, self.INTC_MASK, self.INTC_MASK + 3):
                 self.unmasked.set() if not val else self.unmasked.clear()
+                if self.loop is not None and self.unmasked.is_set():
+                    self.loop.call_soon(self.deliver_pending)
             elif in_range(item, self.INTC_REG_INTNUM, self.INTC_REG_INTNUM + 3):
                 self.reg_intnum = set_word_byte(self.reg_intnum, item - self.INTC_REG_INTNUM, val)
             elif in_range(item, self.INTC_REG_INTVEC, self.INTC_REG_INTVEC + 3):
@@ -114,5 +193,9 @@ class InterruptController(Hardware):
             elif in_range(item, self.INTC_TRIGGER, self.INTC_TRIGGER + 3):
                 if val > 0:
                     self.interrupt(self.reg_intnum)
+            elif in_range(item, self.INTC_IPI, self.INTC_IPI + 3):
+                self.reg_ipi = set_word_byte(self.reg_ipi, item - self.INTC_IPI, val)
+                if item == self.INTC_IPI + 3:
+                    self.send_ipi(self.reg_ipi)
             else:
                 return
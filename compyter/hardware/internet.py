@@ -3,7 +3,6 @@ from ..util import in_range, set_word_byte, get_word_byte
 import threading
 import ipaddress
 import socket
-import selectors
 import errno
 
 
@@ -13,6 +12,8 @@ class Internet(intc.InterruptHardware):
     ADDR_BEGIN = 0xffffe94f
     ADDR_END =   0xffffedaf
 
+    USES_LOOP = True
+
     MAXBUFSIZE = 0x400
 
     # Command registers
@@ -78,34 +79,56 @@ class Internet(intc.InterruptHardware):
 
         self.async_op = 0
         self.async_handle = 0
-        self.async_done = threading.Event()
 
         self.sockets = {}
 
-        self.selector = selectors.DefaultSelector()
-
-        self.async_thread = threading.Thread(target=self.process_async, daemon=True)
-        self.async_thread.start()
-        self.cpu.register_thread(self.async_thread)
-
-    def process_async(self):
-        while not self.cpu.exit_event.is_set():
-            events = self.selector.select(10)
-            for key, mask in events:
-                self.async_op = 0
-                self.async_done.clear()
-
-                if mask & selectors.EVENT_READ:
-                    self.async_op |= self.ASYNC_READ
+        # Sockets watched on the loop, by fd, with the events wanted, and
+        # whether an event is waiting on the guest's CMD_ASYNC_DONE. Commands
+        # come from the CPU thread, events from the loop's.
+        self.watched = {}
+        self.async_busy = False
+        self.async_lock = threading.RLock()
+
+    def attach_loop(self, loop):
+        with self.async_lock:
+            super().attach_loop(loop)
+            if not self.async_busy:
+                for fd in self.watched:
+                    self._watch(fd)
+
+    def detach_loop(self):
+        with self.async_lock:
+            for fd in self.watched:
+                self._unwatch(fd)
+
+            super().detach_loop()
+
+    def _watch(self, fd):
+        if self.watched[fd] & self.ASYNC_READ:
+            self.loop.add_reader(fd, self._ready, fd, self.ASYNC_READ)
+        if self.watched[fd] & self.ASYNC_WRITE:
+            self.loop.add_writer(fd, self._ready, fd, self.ASYNC_WRITE)
+
+    def _unwatch(self, fd):
+        self.loop.remove_reader(fd)
+        self.loop.remove_writer(fd)
+
+    def _ready(self, fd, op):
+        # The loop keeps telling us about a ready socket, so stop watching
+        # until the guest is done with this event
+        with self.async_lock:
+            if self.async_busy or fd not in self.watched:
+                return
 
-                if mask & selectors.EVENT_WRITE:
-                    self.async_op |= self.ASYNC_WRITE
+            for watched in self.watched:
+                self._unwatch(watched)
 
-                self.async_handle = key.fd
-                self.interrupt()
+            self.async_busy = True
+            self.async_op = op
+            self.async_handle = fd
 
-                # Wait for the operation to finish before firing another interrupt
-                self.async_done.wait()
+        self.changed()
+        self.interrupt()
 
     @staticmethod
     def _set_quad_byte(num, byte, val):
@@ -272,6 +295,10 @@ class Internet(intc.InterruptHardware):
             return
 
         sock = self.sockets[self.current_handle][0]
+        with self.async_lock:
+            if self.watched.pop(self.current_handle, None) is not None and self.loop is not None:
+                self._unwatch(self.current_handle)
+
         try:
             sock.close()
         except OSError as e:
@@ -433,16 +460,13 @@ class Internet(intc.InterruptHardware):
             return
 
         sock = self.sockets[self.current_handle][0]
-
-        mask = 0
-        if self.params & self.ASYNC_READ:
-            mask |= selectors.EVENT_READ
-
-        if self.params & self.ASYNC_WRITE:
-            mask |= selectors.EVENT_WRITE
-
         sock.setblocking(False)
-        self.selector.register(sock, mask, None)
+
+        with self.async_lock:
+            self.watched[sock.fileno()] = self.params & (self.ASYNC_READ | self.ASYNC_WRITE)
+            if self.loop is not None and not self.async_busy:
+                self._unwatch(sock.fileno())
+                self._watch(sock.fileno())
 
         self._set_error(0)
 
@@ -451,11 +475,20 @@ class Internet(intc.InterruptHardware):
             return
 
         sock = self.sockets[self.current_handle][0]
-        self.selector.unregister(sock)
+        with self.async_lock:
+            if self.watched.pop(sock.fileno(), None) is not None and self.loop is not None:
+                self._unwatch(sock.fileno())
+
         self._set_error(0)
 
     def _cmd_async_done(self):
-        self.async_done.set()
+        with self.async_lock:
+            if self.async_busy:
+                self.async_busy = False
+                if self.loop is not None:
+                    for fd in self.watched:
+                        self._watch(fd)
+
         self._set_error(0)
 
     CMD_TABLE = {
@@ -479,6 +512,49 @@ class Internet(intc.InterruptHardware):
         CMD_ASYNC_DONE: _cmd_async_done,
     }
 
+    # Registers kept in snapshots. Sockets can't be saved, so a restored
+    # guest finds its handles closed.
+    STATE = ("addr", "ip_ver", "proto", "command", "result", "current_handle",
+             "params", "status", "bufsize", "async_op", "async_handle")
+
+    # Plain word registers, for read_word() and write_word(). Status and
+    # buffer size writes do more than set the word, so they go by byte.
+    WORD_REGS = {
+        REG_IP_VER: "ip_ver",
+        REG_IP_PROTO: "proto",
+        REG_HANDLE: "current_handle",
+        REG_COMMAND: "command",
+        REG_PARAMS: "params",
+        REG_STATUS: "status",
+        REG_ASYNC_OP: "async_op",
+        REG_ASYNC_HANDLE: "async_handle",
+        REG_BUFSIZE: "bufsize",
+    }
+    WRITABLE_WORD_REGS = frozenset(WORD_REGS) - {REG_STATUS, REG_BUFSIZE}
+
+    def save_state(self):
+        state = {name: getattr(self, name) for name in self.STATE}
+        state["buffer"] = self.buffer.hex()
+        return state
+
+    def load_state(self, state):
+        for name in self.STATE:
+            setattr(self, name, state[name])
+        self.buffer = bytearray.fromhex(state["buffer"])
+
+    def read_word(self, item):
+        if item in self.WORD_REGS:
+            return getattr(self, self.WORD_REGS[item]) & 0xffffffff
+        return super().read_word(item)
+
+    def write_word(self, item, val):
+        if item not in self.WRITABLE_WORD_REGS:
+            return super().write_word(item, val)
+
+        setattr(self, self.WORD_REGS[item], val)
+        if item == self.REG_COMMAND and self.command in self.CMD_TABLE:
+            self.CMD_TABLE[self.command](self)
+
     def __getitem__(self, item):
         if in_range(item, self.REG_ADDR, self.REG_ADDR + 15):
             return self._get_quad_byte(self.addr, item)
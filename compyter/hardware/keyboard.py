@@ -1,7 +1,8 @@
 from . import intc
 from ..util import set_word_byte, get_word_byte, in_range
-from threading import Thread
+from threading import Event, Lock
 import tty
+import os
 import sys
 import termios
 
@@ -11,45 +12,152 @@ class Keyboard(intc.InterruptHardware):
     ADDR_BEGIN = 0xffffefc1
     ADDR_END = 0xffffefc8
 
+    USES_LOOP = True
+
     INPUT_REG_ENABLE = 0x0
     INPUT_REG_CHAR = 0x4
 
-    def __init__(self, cpu, memory, intc):
+    def __init__(self, cpu, memory, intc, stream=None):
         super().__init__(cpu, memory, intc)
 
         self.enabled = False
         self.char = 0
 
-        self.input_thread = Thread(target=self.input, daemon=True)
-        self.input_thread.start()
-
-        self.cpu.register_thread(self.input_thread)
-
-    def input(self):
-        # Terminal shenanigans to enable raw input
-        orig_settings = termios.tcgetattr(sys.stdin)
-        tty.setcbreak(sys.stdin)
-        try:
-            while not self.cpu.exit_event.is_set():
-                # We're in a thread so it's okay to block
-                self.char = ord(sys.stdin.read(1)[0])
-                if self.enabled:
-                    self.interrupt()
-        finally:
+        # A binary stream to type from instead of the terminal
+        self.stream = stream
+        self.consumed = Event()
+        self.key_lock = Lock()
+
+        # Terminal settings to put back
+        self.orig_settings = None
+
+    def attach_loop(self, loop):
+        super().attach_loop(loop)
+        if self.stream is None:
+            try:
+                loop.add_reader(sys.stdin.fileno(), self.read_terminal)
+            except PermissionError:
+                # A regular file can't be polled; type it like a stream
+                self.stream = sys.stdin.buffer
+            else:
+                if sys.stdin.isatty():
+                    # Terminal shenanigans to enable raw input
+                    self.orig_settings = termios.tcgetattr(sys.stdin)
+                    tty.setcbreak(sys.stdin)
+                return
+
+        self.consumed.set()
+        loop.call_soon(self.next_key)
+
+    def detach_loop(self):
+        self.loop.remove_reader(sys.stdin.fileno())
+        if self.orig_settings is not None:
             # Set it back to the way it was
-            termios.tcsetattr(sys.stdin, termios.TCSADRAIN, orig_settings)
+            termios.tcsetattr(sys.stdin, termios.TCSADRAIN, self.orig_settings)
+            self.orig_settings = None
             print()
 
+        super().detach_loop()
+
+    def type_char(self, char, paced=False):
+        # A paced key waits for the guest to read it before the next one
+        with self.key_lock:
+            self.char = char
+            if paced:
+                self.consumed.clear()
+
+        self.changed()
+        if self.enabled:
+            self.interrupt()
+
+    def read_terminal(self):
+        # Straight from the fd, as anything sys.stdin buffered wouldn't wake
+        # the loop
+        data = os.read(sys.stdin.fileno(), 1)
+        if not data:
+            # End of piped input
+            self.loop.remove_reader(sys.stdin.fileno())
+            return
+
+        paced = self.orig_settings is None
+        if paced:
+            # Piped in, so pace it like a stream
+            self.loop.remove_reader(sys.stdin.fileno())
+
+        self.type_char(data[0], paced)
+
+    def next_key(self):
+        if self.stream is None:
+            self.loop.add_reader(sys.stdin.fileno(), self.read_terminal)
+        else:
+            self.read_stream()
+
+    def read_stream(self):
+        # Type the stream one key at a time, each once the guest has read the
+        # last one
+        data = self.stream.read(1)
+        if data:
+            self.type_char(data[0], True)
+
+    def save_state(self):
+        return {"enabled": self.enabled, "char": self.char}
+
+    def load_state(self, state):
+        self.enabled = state["enabled"]
+        self.char = state["char"]
+
+    def read_word(self, item):
+        if item == self.INPUT_REG_ENABLE:
+            return int(self.enabled)
+        elif item == self.INPUT_REG_CHAR:
+            with self.key_lock:
+                val = self.char & 0xffffffff
+                if self.loop is not None and not self.consumed.is_set():
+                    self.loop.call_soon(self.next_key)
+
+                self.consumed.set()
+
+            return val
+
+        return super().read_word(item)
+
+    def enable(self, enabled):
+        # A key typed before the guest turned the keyboard on still needs its
+        # interrupt, or an interrupt-driven guest never reads it
+        with self.key_lock:
+            pending = enabled and not self.enabled and not self.consumed.is_set()
+            self.enabled = enabled
+
+        if pending:
+            self.interrupt()
+
+    def write_word(self, item, val):
+        if item == self.INPUT_REG_ENABLE:
+            self.enable(bool(val & 0xff))
+        elif item == self.INPUT_REG_CHAR:
+            self.char = val
+        else:
+            super().write_word(item, val)
+
     def __getitem__(self, item):
         if item == self.INPUT_REG_ENABLE + 3:
             return int(self.enabled) & 0xff
         elif in_range(item, self.INPUT_REG_CHAR, self.INPUT_REG_CHAR + 3):
-            return get_word_byte(self.char, item - self.INPUT_REG_CHAR)
+            with self.key_lock:
+                val = get_word_byte(self.char, item - self.INPUT_REG_CHAR)
+
+                if item == self.INPUT_REG_CHAR + 3:
+                    if self.loop is not None and not self.consumed.is_set():
+                        self.loop.call_soon(self.next_key)
+
+                    self.consumed.set()
+
+            return val
         else:
             return 0
 
     def __setitem__(self, item, val):
         if item == self.INPUT_REG_ENABLE + 3:
-            self.enabled = bool(val)
+            self.enable(bool(val))
         elif in_range(item, self.INPUT_REG_CHAR, self.INPUT_REG_CHAR + 3):
             self.char = set_word_byte(self.char, item - self.INPUT_REG_CHAR, val)
@@ -6,14 +6,25 @@ class Printer(Hardware):
     ADDR_BEGIN = 0xffffefff
     ADDR_END = 0xffffefff
 
-    def __init__(self, cpu, memory):
+    def __init__(self, cpu, memory, output=None):
         super().__init__(cpu, memory)
         self.char = 0
 
+        # Where to print; the current stdout if None
+        self.output = output
+
+    def save_state(self):
+        return {"char": self.char}
+
+    def load_state(self, state):
+        self.char = state["char"]
+
     def __getitem__(self, item):
         return self.char
 
     def __setitem__(self, item, val):
         self.char = val
-        sys.stdout.write(chr(val))
-        sys.stdout.flush()
+
+        output = sys.stdout if self.output is None else self.output
+        output.write(chr(val))
+        output.flush()
@@ -21,6 +21,19 @@ class RTC(Hardware):
 
         self.now = datetime.now()
 
+    def save_state(self):
+        return {"now": self.now.isoformat()}
+
+    def load_state(self, state):
+        self.now = datetime.fromisoformat(state["now"])
+
+    def read_word(self, item):
+        if item == self.REG_YEAR:
+            return self.now.year
+        elif item == self.REG_USEC:
+            return self.now.microsecond
+        return super().read_word(item)
+
     def __getitem__(self, item):
         if in_range(item, self.REG_YEAR, self.REG_YEAR + 3):
             return get_word_byte(self.now.year, item)
@@ -27,7 +27,57 @@ class Storage(Hardware):
             self.storage_map.close()
 
         if hasattr(self, "storage_fd"):
-            self.storage_fd.close()
+            os.close(self.storage_fd)
+
+    def save_state(self):
+        # The storage image itself is the caller's to keep
+        return {"offset": self.offset, "wrenable": self.wrenable}
+
+    def load_state(self, state):
+        self.offset = state["offset"]
+        self.wrenable = state["wrenable"]
+
+    def read_word(self, item):
+        if item == self.REG_OFFSET:
+            return self.offset
+        elif item == self.REG_WRENABLE:
+            return int(self.wrenable)
+        elif item == self.REG_SIZE:
+            return self.storage_size & 0xffffffff
+        return super().read_word(item)
+
+    def write_word(self, item, val):
+        if item == self.REG_OFFSET:
+            self.offset = val
+        elif item == self.REG_WRENABLE:
+            # Each byte sets it, so the last one wins
+            self.wrenable = bool(val & 0xff)
+        else:
+            super().write_word(item, val)
+
+    def _window(self, item, length):
+        # Where item..item+length falls in the image, if all in the window
+        begin = self.offset + item - self.REG_STORAGE
+        if (item >= self.REG_STORAGE and item + length <= self.REG_STORAGE + 512
+                and begin + length <= self.storage_size):
+            return begin
+
+        return None
+
+    def read_range(self, item, length):
+        begin = self._window(item, length)
+        if begin is None:
+            return super().read_range(item, length)
+
+        return bytearray(self.storage_map[begin:begin + length])
+
+    def write_range(self, item, data):
+        begin = self._window(item, len(data))
+        if begin is None:
+            return super().write_range(item, data)
+
+        if self.wrenable:
+            self.storage_map[begin:begin + len(data)] = bytes(data)
 
     def __getitem__(self, item):
         if in_range(item, self.REG_OFFSET, self.REG_OFFSET + 3):
@@ -1,7 +1,6 @@
 from . import intc
 from ..util import set_word_byte, get_word_byte
-from time import sleep
-from threading import Thread
+from threading import Lock
 
 class Timer(intc.InterruptHardware):
     INT_NUM = 32
@@ -9,24 +8,70 @@ class Timer(intc.InterruptHardware):
     ADDR_BEGIN = 0xffffefc9
     ADDR_END = 0xffffefcc
 
+    USES_LOOP = True
+
     def __init__(self, cpu, memory, intc):
         super().__init__(cpu, memory, intc)
 
         self.duration = 0
 
-        self.timer_thread = Thread(target=self.timer, daemon=True)
-        self.timer_thread.start()
+        # Pending loop.call_later() for the next tick. The guest re-arms from
+        # the CPU thread while ticks re-arm from the loop's.
+        self.handle = None
+        self.timer_lock = Lock()
+
+    def attach_loop(self, loop):
+        super().attach_loop(loop)
+        self.rearm()
+
+    def detach_loop(self):
+        with self.timer_lock:
+            if self.handle is not None:
+                self.handle.cancel()
+                self.handle = None
+
+            super().detach_loop()
+
+    def rearm(self):
+        with self.timer_lock:
+            if self.handle is not None:
+                self.handle.cancel()
+                self.handle = None
+
+            if self.loop is not None and self.duration > 0:
+                self.handle = self.loop.call_later(self.duration / 1000, self.tick)
 
-        self.cpu.register_thread(self.timer_thread)
+    def tick(self):
+        self.interrupt()
+        self.rearm()
 
-    def timer(self):
-        while not self.cpu.exit_event.is_set():
-            sleep(self.duration / 1000)
-            if self.duration > 0:
-                self.interrupt()
+    def save_state(self):
+        return {"duration": self.duration}
+
+    def load_state(self, state):
+        self.duration = state["duration"]
+        self.rearm()
+
+    def read_word(self, item):
+        if item == 0:
+            return self.duration
+        return super().read_word(item)
+
+    def write_word(self, item, val):
+        if item != 0:
+            return super().write_word(item, val)
+
+        self.duration = val
+        if self.loop is not None and (self.handle is None or self.duration == 0):
+            self.rearm()
 
     def __getitem__(self, item):
         return get_word_byte(self.duration, item)
 
     def __setitem__(self, item, val):
         self.duration = set_word_byte(self.duration, item, val)
+
+        # A running timer keeps its period; the new duration applies from
+        # the next tick
+        if self.loop is not None and item == 3 and (self.handle is None or self.duration == 0):
+            self.rearm()
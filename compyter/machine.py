@@ -1,28 +1,332 @@
-from . import cpu, memory
-from .hardware import printer, intc, timer, keyboard, storage, internet, rtc
+from . import cpu, memory, aot
+from .register import RegisterName
+from importlib import import_module
 from time import sleep
+import os
+
+
+# Every device a machine can have, in the order they're attached
+DEVICES = ("intc", "timer", "keyboard", "printer", "internet", "rtc", "storage")
+
+# Devices that raise interrupts, and so need the interrupt controller
+INTERRUPT_DEVICES = ("timer", "keyboard", "internet")
+
+# Each device's class, in compyter.hardware.<name>
+DEVICE_CLASSES = {
+    "intc": "InterruptController",
+    "timer": "Timer",
+    "keyboard": "Keyboard",
+    "printer": "Printer",
+    "internet": "Internet",
+    "rtc": "RTC",
+    "storage": "Storage",
+}
+
+
+def load_symbols(filename):
+    # Labels written by the assembler next to the image, if any
+    symbols = {}
+    if not os.path.exists(filename + ".sym"):
+        return symbols
+
+    with open(filename + ".sym") as f:
+        for line in f:
+            name, addr = line.split()
+            symbols[name] = int(addr, 16)
+
+    return symbols
+
+
+def device_class(name):
+    module = import_module(".hardware." + name, __package__)
+    return getattr(module, DEVICE_CLASSES[name])
+
+
+class RunResult:
+    # Why run_until() returned
+    HALT = "halt"
+    BREAKPOINT = "breakpoint"
+    BUDGET = "budget"
+    CONDITION = "condition"
+    WAIT = "wait"
+
+    def __init__(self, reason, instructions, pc):
+        self.reason = reason
+        self.instructions = instructions
+        self.pc = pc
+
+    def __repr__(self):
+        return f"RunResult({self.reason!r}, {self.instructions}, {self.pc:#x})"
+
 
 class Machine:
-    def __init__(self, filename):
-        self.memory = memory.Memory.load_file(filename)
+    def __init__(self, filename, translate=False, storage_file="storage.img",
+                 input_stream=None, output=None, asynchronous=False, devices=None,
+                 mem=None, remote_devices=None, ram_size=None):
+        # mem is memory loaded some other way, e.g. from a snapshot; filename
+        # is then only used to find symbols. remote_devices are run in a
+        # device process of their own. ram_size gives the guest that much RAM
+        # rather than just the image's size.
+        self.filename = filename
+        self.translate = translate
+        if mem is None:
+            self.memory = memory.Memory.load_file(filename, ram_size)
+        else:
+            self.memory = mem
         self.cpu = cpu.CPU(self.memory)
+        self.symbols = load_symbols(filename)
+
+        # Id of the snapshot this machine was last saved to or restored from
+        self.snapshot_id = None
+
+        if translate and mem is None:
+            # Use the ahead-of-time translation of this image if there is one
+            aot.load_translations(self.cpu, filename)
+
+        self.asynchronous = asynchronous
+
+        # Only the devices asked for are built, and their modules imported, so
+        # e.g. a headless run needn't touch the terminal or the network
+        if devices is None:
+            devices = DEVICES
+        remote = set(remote_devices or ())
+        devices = set(devices) | remote
+
+        if "intc" in remote:
+            raise ValueError("The interrupt controller can't be a remote device")
+
+        unknown = devices - set(DEVICES)
+        if unknown:
+            raise ValueError(f"Unknown devices {', '.join(sorted(unknown))}")
+
+        if devices & set(INTERRUPT_DEVICES):
+            devices.add("intc")
+
+        # Storage is optional, there may be no image to back it
+        if storage_file is None:
+            devices.discard("storage")
+
+        self.device_host = None
+        if remote:
+            # multiprocessing pulls in socket, so only import it if used
+            from . import devhost
+
+            self.device_host = devhost.DeviceHost(
+                self.cpu, lambda name, cpu, intc: self._build_device(
+                    name, storage_file, input_stream, output, cpu, intc))
+
+        # self.devices are those run here; remote ones are only attached
+        self.devices = []
+        self.intc = None
+        for name in DEVICES:
+            device = None
+            if name in remote:
+                device = self.device_host.add(name, device_class(name), self.memory)
+                self.memory.attach_hardware(device)
+            elif name in devices:
+                device = self._build_device(name, storage_file, input_stream, output)
+                self.devices.append(device)
+                self.memory.attach_hardware(device)
+
+            setattr(self, name, device)
+
+        if self.device_host is not None:
+            self.device_host.start(self.intc)
+
+        # All devices share one thread, if any of them need it; under
+        # run_async() they use the asyncio loop instead
+        self.reactor = None
+        if not asynchronous:
+            self.start_devices()
+
+    def start_devices(self):
+        if self.device_host is None and not any(device.USES_LOOP for device in self.devices):
+            return
+
+        # The reactor pulls in selectors, so only import it if used
+        from . import reactor
+
+        self.reactor = reactor.Reactor(self.cpu)
+        for device in self.devices:
+            self.reactor.attach(device)
+        if self.device_host is not None:
+            self.reactor.attach(self.device_host)
+        self.reactor.start()
+
+    def stop_devices(self):
+        # Leaves the machine with no threads of its own, e.g. to fork it.
+        # Devices keep their state for start_devices().
+        if self.reactor is not None:
+            self.reactor.stop()
+            self.reactor = None
+
+    def _build_device(self, name, storage_file, input_stream, output, cpu=None, intc=None):
+        # cpu and intc are stand-ins for a device built in a device process
+        cls = device_class(name)
+        if cpu is None:
+            cpu, intc = self.cpu, self.intc
+
+        if name == "keyboard":
+            return cls(cpu, self.memory, intc, input_stream)
+        elif name in INTERRUPT_DEVICES:
+            return cls(cpu, self.memory, intc)
+        elif name == "printer":
+            return cls(cpu, self.memory, output)
+        elif name == "storage":
+            return cls(cpu, self.memory, storage_file)
+        return cls(cpu, self.memory)
+
+    def resolve(self, target):
+        # An address, or a label from the image's symbols
+        if isinstance(target, str):
+            if target not in self.symbols:
+                raise ValueError(f"Unknown label {target}")
+
+            return self.symbols[target]
+
+        return target
+
+    def _add_breakpoints(self, pc):
+        # Breakpoints for run_until()'s pc; returns those it has to remove
+        if pc is None:
+            targets = []
+        elif isinstance(pc, (list, tuple, set)):
+            targets = [self.resolve(target) for target in pc]
+        else:
+            targets = [self.resolve(pc)]
+
+        added = [target for target in targets if target not in self.cpu.breakpoints]
+        for target in added:
+            self.cpu.add_breakpoint(target)
+
+        return added
+
+    def _stop_reason(self, executed, max_instructions, until):
+        if self.cpu.halted:
+            return RunResult.HALT
+
+        if executed and self.cpu.registers[RegisterName.REG_PC] in self.cpu.breakpoints:
+            return RunResult.BREAKPOINT
+
+        if max_instructions is not None and executed >= max_instructions:
+            return RunResult.BUDGET
+
+        if until is not None and until(self):
+            return RunResult.CONDITION
+
+        return None
+
+    def run_until(self, max_instructions=None, pc=None, until=None, quantum=1000):
+        # Run until the guest halts, max_instructions have run, the PC reaches
+        # pc (an address, a label or a list of them), or until(machine)
+        # returns true. until is only checked every quantum instructions.
+        # A guest that waits with no interrupt to take returns WAIT rather
+        # than blocking us; wait() for a device, or go and run something else.
+        # Returns a RunResult; call again to carry on.
+        added = self._add_breakpoints(pc)
+
+        executed = 0
+        try:
+            while True:
+                reason = self._stop_reason(executed, max_instructions, until)
+                if reason is not None:
+                    break
+
+                if self.cpu.waiting:
+                    if not self.cpu.trap_event.is_set():
+                        reason = RunResult.WAIT
+                        break
+                    self.cpu.waiting = False
+
+                if max_instructions is None:
+                    left, limit = quantum, None
+                else:
+                    limit = max_instructions - executed
+                    left = min(quantum, limit)
+
+                executed += self.cpu.run(left, self.translate, park=False, limit=limit)
+                if self.cpu.spinning:
+                    self.cpu.park()
+        finally:
+            for target in added:
+                self.cpu.remove_breakpoint(target)
+
+        return RunResult(reason, executed, self.cpu.registers[RegisterName.REG_PC])
+
+    def wait(self, timeout=None):
+        # Block until a guest run_until() left waiting has an interrupt to
+        # take, or timeout seconds pass. Returns false on a timeout.
+        return self.cpu.trap_event.wait(timeout)
+
+    async def run_async(self, max_instructions=None, pc=None, until=None, quantum=1000):
+        # run_until() for a machine built with asynchronous=True. Devices run
+        # as callbacks on the running event loop rather than a reactor, and we
+        # yield to it between slices of quantum instructions. A waiting or
+        # polling guest doesn't take a slice again until a device wakes it.
+        if not self.asynchronous:
+            raise RuntimeError("Machine was not built with asynchronous=True")
+
+        # asyncio pulls in socket and selectors, so only import it if used
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        wake = asyncio.Event()
+        self.cpu.wakeup = wake.set
+        for device in self.devices:
+            device.attach_loop(loop)
+        if self.device_host is not None:
+            self.device_host.attach_loop(loop)
+
+        added = self._add_breakpoints(pc)
+
+        executed = 0
+        try:
+            while True:
+                reason = self._stop_reason(executed, max_instructions, until)
+                if reason is not None:
+                    break
+
+                if max_instructions is None:
+                    left, limit = quantum, None
+                else:
+                    limit = max_instructions - executed
+                    left = min(quantum, limit)
+
+                wake.clear()
+                executed += self.cpu.run(left, self.translate, park=False, limit=limit)
+
+                if self.cpu.waiting:
+                    # trap_event is set once there's an interrupt to take;
+                    # wake also fires for changed registers and masked
+                    # interrupts, which mustn't end the wait
+                    while not self.cpu.trap_event.is_set():
+                        await wake.wait()
+                        wake.clear()
+                    self.cpu.waiting = False
+                elif self.cpu.spinning:
+                    try:
+                        await asyncio.wait_for(wake.wait(), self.cpu.SPIN_PARK)
+                    except asyncio.TimeoutError:
+                        pass
+                    self.cpu.spinning = False
+                else:
+                    await asyncio.sleep(0)
+        finally:
+            for target in added:
+                self.cpu.remove_breakpoint(target)
+
+            for device in self.devices:
+                device.detach_loop()
+            if self.device_host is not None:
+                self.device_host.detach_loop()
+            self.cpu.wakeup = None
+
+        return RunResult(reason, executed, self.cpu.registers[RegisterName.REG_PC])
 
-        self.intc = intc.InterruptController(self.cpu, self.memory)
-        self.timer = timer.Timer(self.cpu, self.memory, self.intc)
-        self.keyboard = keyboard.Keyboard(self.cpu, self.memory, self.intc)
-        self.printer = printer.Printer(self.cpu, self.memory)
-        self.storage = storage.Storage(self.cpu, self.memory)
-        self.internet = internet.Internet(self.cpu, self.memory, self.intc)
-        self.rtc = rtc.RTC(self.cpu, self.memory)
-
-        self.memory.attach_hardware(self.intc)
-        self.memory.attach_hardware(self.timer)
-        self.memory.attach_hardware(self.keyboard)
-        self.memory.attach_hardware(self.printer)
-        self.memory.attach_hardware(self.storage)
-        self.memory.attach_hardware(self.internet)
-        self.memory.attach_hardware(self.rtc)
-
-    def run(self):
-        while True:
-            self.cpu.decode_next_instr()
+    def run(self, quantum=1):
+        # quantum is the number of instructions run per hold of the CPU lock.
+        # Larger values favour guest throughput, smaller values let device
+        # threads in sooner.
+        while self.run_until(quantum=quantum).reason == RunResult.WAIT:
+            self.wait()
+        print(self.cpu.registers.pretty_format())
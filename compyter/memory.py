@@ -1,63 +1,350 @@
+from bisect import bisect_right, insort
+import mmap
+import os
+
+
 class Memory:
-    def __init__(self, memory=None):
-        self.hardware_mmio = {}
+    # Cached code is tracked in lines of 1 << CODE_SHIFT bytes, small enough
+    # that stores to data next to the code don't flush it.
+    CODE_SHIFT = 6
+
+    # Writes are tracked in pages of 1 << PAGE_SHIFT bytes, for incremental
+    # snapshots and the like
+    PAGE_SHIFT = 12
+    PAGE_SIZE = 1 << PAGE_SHIFT
+
+    # Trap vectors take up the top page of the address space
+    TRAP_BASE = 0xfffff000
 
-        self.trap_vectors = bytearray(4096)
+    # Largest RAM there's room for under the devices
+    MAX_RAM = 0xffffe000
+
+    def __init__(self, memory=None, trap_vectors=None):
+        # Devices as sorted (begin, end, hardware), and their begins for
+        # bisecting. Everything below mmio_begin is RAM, so RAM accesses get
+        # by with a single comparison.
+        self.regions = []
+        self.region_begins = []
+        self.mmio_begin = self.TRAP_BASE
+
+        # Lines holding cached decoded instructions
+        self.code_lines = set()
+        self.code_watchers = []
+
+        if trap_vectors is None:
+            self.trap_vectors = bytearray(4096)
+        else:
+            self.trap_vectors = trap_vectors
 
         if memory is None:
             self.memory = bytearray(4096)
         else:
             self.memory = memory
 
+        # One byte per page of RAM, set when the page is written, and folded
+        # into each of the dirty logs when one is looked at
+        self.dirty = bytearray(self.pages())
+        self.dirty_logs = {}
+
+    @classmethod
+    def allocate(cls, size):
+        # size bytes of zeroed RAM, as an anonymous private mapping. The host
+        # only backs pages once they're written; until then they all read
+        # from its zero page, so a guest can have up to MAX_RAM without the
+        # host finding it.
+        if not 0 < size <= cls.MAX_RAM:
+            raise ValueError(f"RAM size must be between 1 and {cls.MAX_RAM:#x} bytes")
+
+        # Don't have the host set aside swap for RAM that's mostly never used
+        flags = mmap.MAP_PRIVATE | mmap.MAP_ANONYMOUS | getattr(mmap, "MAP_NORESERVE", 0)
+        return mmap.mmap(-1, size, flags=flags)
+
     @classmethod
-    def load_file(cls, filename):
+    def load_file(cls, filename, size=None):
+        # RAM is as big as the image unless a size is given. The image is
+        # mapped copy-on-write, so it's read in as the guest touches it, and
+        # pages are shared by every process running it until they're written.
         with open(filename, 'rb') as f:
-            memory = bytearray(f.read())
+            if size is None and os.fstat(f.fileno()).st_size >= 4096:
+                return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY))
 
-        if len(memory) < 4096:
-            memory.extend(0 for _ in range(4096 - len(memory)))
+            image = f.read()
 
+        # A mapping can't run past the end of the file, so copy it into RAM
+        # that's bigger
+        if size is None:
+            size = 4096
+        elif size < len(image):
+            raise ValueError(f"{filename} is bigger than {size:#x} bytes of RAM")
+
+        memory = cls.allocate(size)
+        memory[:len(image)] = image
         return cls(memory)
 
     def attach_hardware(self, hardware):
-        for i in range(hardware.ADDR_BEGIN, hardware.ADDR_END + 1):
-            self.hardware_mmio[i] = hardware
+        begin, end = hardware.ADDR_BEGIN, hardware.ADDR_END
+        if self.is_mmio(begin, end - begin + 1):
+            raise ValueError(f"{type(hardware).__name__} overlaps another device "
+                             f"at {begin:#x}-{end:#x}")
+
+        insort(self.regions, (begin, end, hardware), key=lambda region: region[0])
+        self._regions_changed(begin, end)
+
+    def detach_hardware(self, hardware):
+        self.regions = [region for region in self.regions if region[2] is not hardware]
+        self._regions_changed(hardware.ADDR_BEGIN, hardware.ADDR_END)
+
+    def _regions_changed(self, begin, end):
+        self.region_begins = [region[0] for region in self.regions]
+        self.mmio_begin = min(self.region_begins[:1] + [self.TRAP_BASE])
+
+        # Code cached there was decoded as RAM or as device memory
+        for line in self.lines_of(begin, end - begin + 1):
+            if line in self.code_lines:
+                self.code_written(line)
+
+    def hardware_at(self, addr):
+        # The device at addr, or None
+        i = bisect_right(self.region_begins, addr) - 1
+        if i >= 0 and addr <= self.regions[i][1]:
+            return self.regions[i][2]
+
+        return None
+
+    def add_code_watcher(self, watcher):
+        self.code_watchers.append(watcher)
+
+    @classmethod
+    def lines_of(cls, addr, length):
+        return range(addr >> cls.CODE_SHIFT, ((addr + length - 1) >> cls.CODE_SHIFT) + 1)
+
+    def watch_code(self, addr, length):
+        self.code_lines.update(self.lines_of(addr, length))
+
+    def code_written(self, line):
+        self.code_lines.discard(line)
+        for watcher in self.code_watchers:
+            watcher(line)
+
+    def pages(self):
+        return (len(self.memory) + self.PAGE_SIZE - 1) >> self.PAGE_SHIFT
+
+    @staticmethod
+    def _flagged(flags):
+        # Indexes of the set bytes, found in C as big guests have many pages
+        pages = []
+        page = flags.find(1)
+        while page != -1:
+            pages.append(page)
+            page = flags.find(1, page + 1)
+
+        return pages
+
+    def _fold_dirty(self):
+        pages = self._flagged(self.dirty)
+        for flags in self.dirty_logs.values():
+            for page in pages:
+                flags[page] = 1
+
+        for page in pages:
+            self.dirty[page] = 0
+
+    def track_dirty(self, log):
+        # Start a log of pages written from now on, if there isn't one called
+        # log already. Each user (snapshots, a tool copying a running guest)
+        # keeps its own, so clearing one leaves the others be.
+        if log not in self.dirty_logs:
+            self._fold_dirty()
+            self.dirty_logs[log] = bytearray(self.pages())
+
+    def dirty_pages(self, log):
+        # Pages of RAM written since log was started or they were cleared
+        self._fold_dirty()
+        return self._flagged(self.dirty_logs[log])
+
+    def clear_dirty(self, log, pages):
+        # Call once pages are safely copied; if that fails they stay dirty
+        flags = self.dirty_logs[log]
+        for page in pages:
+            flags[page] = 0
+
+    def take_dirty(self, log):
+        # dirty_pages(), starting afresh. A copy of the pages made after this
+        # is only missing what is written after it, which the next call picks
+        # up; handy for copying a running guest in rounds.
+        pages = self.dirty_pages(log)
+        self.clear_dirty(log, pages)
+        return pages
+
+    def is_mmio(self, addr, length=1):
+        if addr + length <= self.mmio_begin:
+            return False
+
+        # Regions don't overlap, so only the last one starting in range can
+        # reach it
+        i = bisect_right(self.region_begins, addr + length - 1) - 1
+        return i >= 0 and self.regions[i][1] >= addr
+
+    def read_word(self, addr):
+        # Big-endian word at addr. A word all in RAM is read in one go, and
+        # one all in a device goes to it whole.
+        if addr + 3 < self.mmio_begin:
+            word = self.memory[addr:addr + 4]
+            if len(word) == 4:
+                return int.from_bytes(word, "big")
+
+        i = bisect_right(self.region_begins, addr) - 1
+        if i >= 0 and addr + 3 <= self.regions[i][1]:
+            begin, _, hardware = self.regions[i]
+            return hardware.read_word(addr - begin)
+
+        return (self[addr] << 24) | (self[addr + 1] << 16) | (self[addr + 2] << 8) | self[addr + 3]
+
+    def write_word(self, addr, value):
+        value &= 0xffffffff
+        first, last = addr >> self.CODE_SHIFT, (addr + 3) >> self.CODE_SHIFT
+        if first in self.code_lines:
+            self.code_written(first)
+        if last in self.code_lines:
+            self.code_written(last)
+
+        if addr + 3 < self.mmio_begin and addr + 4 <= len(self.memory):
+            self.dirty[addr >> self.PAGE_SHIFT] = 1
+            self.dirty[(addr + 3) >> self.PAGE_SHIFT] = 1
+            self.memory[addr:addr + 4] = value.to_bytes(4, "big")
+            return
+
+        i = bisect_right(self.region_begins, addr) - 1
+        if i >= 0 and addr + 3 <= self.regions[i][1]:
+            begin, _, hardware = self.regions[i]
+            hardware.write_word(addr - begin, value)
+            return
+
+        self[addr] = (value >> 24) & 0xff
+        self[addr + 1] = (value >> 16) & 0xff
+        self[addr + 2] = (value >> 8) & 0xff
+        self[addr + 3] = value & 0xff
 
     def __len__(self):
         # XXX - physical memory size only!
         return len(self.memory)
 
+    def _runs(self, addr, stop):
+        # Split addr..stop into runs that are all RAM, all trap vectors or
+        # all one device, as (addr, end, hardware, buffer, base): one of
+        # hardware or buffer is set, and base is where it starts
+        while addr < stop:
+            if addr >= self.TRAP_BASE:
+                buffer, base, end = self.trap_vectors, self.TRAP_BASE, stop
+            else:
+                i = bisect_right(self.region_begins, addr) - 1
+                if i >= 0 and addr <= self.regions[i][1]:
+                    base, last, hardware = self.regions[i]
+                    end = min(stop, last + 1)
+                    yield addr, end, hardware, None, base
+                    addr = end
+                    continue
+
+                # RAM, up to the next device
+                if i + 1 < len(self.region_begins):
+                    end = min(stop, self.region_begins[i + 1])
+                else:
+                    end = min(stop, self.TRAP_BASE)
+                buffer, base = self.memory, 0
+
+            if end - base > len(buffer):
+                raise IndexError("memory address out of range")
+
+            yield addr, end, None, buffer, base
+            addr = end
+
+    def read_range(self, addr, length):
+        # length bytes from addr, copied a run at a time rather than byte by
+        # byte; a run of device registers goes to the device's read_range()
+        stop = addr + length
+        if stop <= self.mmio_begin and stop <= len(self.memory):
+            return bytearray(self.memory[addr:stop])
+
+        data = bytearray()
+        for begin, end, hardware, buffer, base in self._runs(addr, stop):
+            if hardware is not None:
+                data += hardware.read_range(begin - base, end - begin)
+            else:
+                data += buffer[begin - base:end - base]
+
+        return data
+
+    def write_range(self, addr, data):
+        # read_range() the other way; data is bytes-like
+        stop = addr + len(data)
+        if self.code_lines:
+            for line in self.code_lines.intersection(self.lines_of(addr, len(data))):
+                self.code_written(line)
+
+        for begin, end, hardware, buffer, base in self._runs(addr, stop):
+            run = data[begin - addr:end - addr]
+            if hardware is not None:
+                hardware.write_range(begin - base, run)
+                continue
+
+            if buffer is self.memory:
+                first, last = begin >> self.PAGE_SHIFT, (end - 1) >> self.PAGE_SHIFT
+                self.dirty[first:last + 1] = b"\x01" * (last + 1 - first)
+            buffer[begin - base:end - base] = run
+
     def __getitem__(self, item):
         if isinstance(item, slice):
+            if item.step is None:
+                return self.read_range(item.start, max(item.stop - item.start, 0))
+
             m = max(item.start, item.stop)
             return bytearray(self[i] for i in range(*item.indices(m + 1)))
 
-        if item >= 0xfffff000:
+        if item < self.mmio_begin:
+            return self.memory[item]
+
+        if item >= self.TRAP_BASE:
             # Trap vector, redirect
-            return self.trap_vectors[item - 0xfffff000]
+            return self.trap_vectors[item - self.TRAP_BASE]
 
-        if item in self.hardware_mmio:
-            hardware = self.hardware_mmio[item]
+        i = bisect_right(self.region_begins, item) - 1
+        if i >= 0 and item <= self.regions[i][1]:
+            hardware = self.regions[i][2]
             return hardware[item - hardware.ADDR_BEGIN]
 
         return self.memory[item]
 
     def __setitem__(self, item, value):
         if isinstance(item, slice):
+            if item.step is None and len(value) == item.stop - item.start:
+                self.write_range(item.start, value)
+                return
+
             m = max(item.start, item.stop)
             for i, j in enumerate(range(*item.indices(m + 1))):
                 self[j] = value[i]
 
             return
 
-        if item >= 0xfffff000:
+        if (item >> self.CODE_SHIFT) in self.code_lines:
+            # Drop stale decoded instructions
+            self.code_written(item >> self.CODE_SHIFT)
+
+        if item < self.mmio_begin:
+            self.dirty[item >> self.PAGE_SHIFT] = 1
+            self.memory[item] = value & 0xff
+            return
+
+        if item >= self.TRAP_BASE:
             # Trap vector, redirect
-            self.trap_vectors[item - 0xfffff000] = value & 0xff
+            self.trap_vectors[item - self.TRAP_BASE] = value & 0xff
             return
 
-        if item in self.hardware_mmio:
-            hardware = self.hardware_mmio[item]
+        i = bisect_right(self.region_begins, item) - 1
+        if i >= 0 and item <= self.regions[i][1]:
+            hardware = self.regions[i][2]
             hardware[item - hardware.ADDR_BEGIN] = value
             return
 
+        self.dirty[item >> self.PAGE_SHIFT] = 1
         self.memory[item] = value & 0xff
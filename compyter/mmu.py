@@ -193,25 +193,38 @@ class MMU:
         page = pte.addr << 12
         return self.memory[page:page+pagesize]
 
-    @lru_cache
+    def check_read(self, addr, mask):
+        pagesize, pte = self.get_pte(addr)
+        if not (pte & mask):
+            # Mask doesn't match
+            raise PageFaultException(addr)
+
+        if not pte.user and self.cpu.registers.user_bit:
+            # Kernel mode only, sorry
+            raise PageFaultException(addr)
+
+        pte.acc = 1
+        self.pte_writeback(addr, pte)
+
+    # Not cached: memory and device registers change under us
     def get_address(self, addr, mask=PTEAccess.PTE_READ):
         mask |= PTEAccess.PTE_READ
 
         if self.cpu.registers.mmu_bit:
-            pagesize, pte = self.get_pte(addr)
-            if not (pte & mask):
-                # Mask doesn't match
-                raise PageFaultException(addr)
-
-            if not pte.user and self.cpu.registers.user_bit:
-                # Kernel mode only, sorry
-                raise PageFaultException(addr)
-        
-            pte.acc = 1
-            self.pte_writeback(addr, pte)
+            self.check_read(addr, mask)
 
         return self.memory[addr]
 
+    def get_word(self, addr, mask=PTEAccess.PTE_READ):
+        # A word can only span two pages, so its ends cover it
+        mask |= PTEAccess.PTE_READ
+
+        if self.cpu.registers.mmu_bit:
+            self.check_read(addr, mask)
+            self.check_read(addr + 3, mask)
+
+        return self.memory.read_word(addr)
+
     def write_page(self, addr, data):
         if not self.cpu.registers.mmu_bit:
             addr &= 0xfffff000
@@ -229,24 +242,35 @@ class MMU:
         page = pte.addr << 12
         self.memory[page:page+pagesize] = data
         
+    def check_write(self, addr, mask):
+        pagesize, pte = self.get_pte(addr)
+        if not (pte & mask):
+            raise PageFaultException(addr)
+
+        if not pte.user and self.cpu.registers.user_bit:
+            # Kernel mode only, sorry
+            raise PageFaultException(addr)
+
+        pte.dirty = 1
+        self.pte_writeback(addr, pte)
+
     def write_address(self, addr, value, mask=PTEAccess.PTE_WRITE):
         mask |= PTEAccess.PTE_WRITE
 
         if self.cpu.registers.mmu_bit:
-            pagesize, pte = self.get_pte(addr)
-            if not (pte & mask):
-                raise PageFaultException(addr)
+            self.check_write(addr, mask)
 
-            if not pte.user and self.cpu.registers.user_bit:
-                # Kernel mode only, sorry
-                raise PageFaultException(addr)
+        self.memory[addr] = value
 
-            pte.dirty = 1
-            self.pte_writeback(addr, pte)
+    def write_word(self, addr, value, mask=PTEAccess.PTE_WRITE):
+        mask |= PTEAccess.PTE_WRITE
 
-        self.memory[addr] = value
+        if self.cpu.registers.mmu_bit:
+            self.check_write(addr, mask)
+            self.check_write(addr + 3, mask)
+
+        self.memory.write_word(addr, value)
 
     def clear_cache(self):
         self.get_page.cache_clear()
-        self.get_address.cache_clear()
         self.get_pte.cache_clear()
@@ -0,0 +1,202 @@
+from threading import Thread, Lock, get_ident
+from collections import deque
+import heapq
+import os
+import selectors
+import time
+import traceback
+
+
+class Call:
+    # Returned by call_later() so the call can be cancelled
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __lt__(self, other):
+        return self.when < other.when
+
+
+class Reactor:
+    # One thread per machine running all device I/O and timers off a single
+    # selector (epoll on Linux). It has the bits of the asyncio loop
+    # interface the devices use, so they run the same way under
+    # Machine.run_async(). Unlike asyncio, everything but run() may be
+    # called from other threads, i.e. the CPU's.
+
+    # Longest we block without checking for the CPU halting
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.selector = selectors.DefaultSelector()
+        self.lock = Lock()
+        self.ready = deque()
+        self.timers = []
+        self.readers = {}
+        self.writers = {}
+        self.devices = []
+
+        # Other threads write here to get us out of select()
+        self.wake_recv, self.wake_send = os.pipe()
+        os.set_blocking(self.wake_recv, False)
+        os.set_blocking(self.wake_send, False)
+        self.selector.register(self.wake_recv, selectors.EVENT_READ)
+
+        self.thread = Thread(target=self.run, daemon=True)
+        self.stopping = False
+
+    def attach(self, device):
+        self.devices.append(device)
+        device.attach_loop(self)
+
+    def start(self):
+        self.thread.start()
+        self.cpu.register_thread(self.thread, self.wake)
+
+    def stop(self):
+        # Stop without halting the CPU; the devices keep their state and can
+        # be attached to another reactor
+        self.stopping = True
+        self.wake()
+        self.thread.join()
+
+    def wake(self):
+        if get_ident() == self.thread.ident or self.wake_send is None:
+            return
+
+        try:
+            os.write(self.wake_send, b"\0")
+        except OSError:
+            # Plenty of wakeups queued already, or we've stopped
+            pass
+
+    def time(self):
+        return time.monotonic()
+
+    def call_soon(self, callback, *args):
+        self.ready.append((callback, args))
+        self.wake()
+
+    def call_later(self, delay, callback, *args):
+        call = Call(time.monotonic() + delay, callback, args)
+        with self.lock:
+            heapq.heappush(self.timers, call)
+        self.wake()
+        return call
+
+    def _update(self, fd):
+        # Bring the selector in line with readers and writers; call locked
+        mask = 0
+        if fd in self.readers:
+            mask |= selectors.EVENT_READ
+        if fd in self.writers:
+            mask |= selectors.EVENT_WRITE
+
+        try:
+            self.selector.get_key(fd)
+        except KeyError:
+            if mask:
+                self.selector.register(fd, mask)
+            return
+
+        if mask:
+            self.selector.modify(fd, mask)
+        else:
+            self.selector.unregister(fd)
+
+    def add_reader(self, fd, callback, *args):
+        with self.lock:
+            self.readers[fd] = (callback, args)
+            self._update(fd)
+        self.wake()
+
+    def add_writer(self, fd, callback, *args):
+        with self.lock:
+            self.writers[fd] = (callback, args)
+            self._update(fd)
+        self.wake()
+
+    def remove_reader(self, fd):
+        with self.lock:
+            if self.readers.pop(fd, None) is None:
+                return False
+            self._update(fd)
+            return True
+
+    def remove_writer(self, fd):
+        with self.lock:
+            if self.writers.pop(fd, None) is None:
+                return False
+            self._update(fd)
+            return True
+
+    @staticmethod
+    def _call(callback, args):
+        # A broken device shouldn't take the others down with it
+        try:
+            callback(*args)
+        except Exception:
+            traceback.print_exc()
+
+    def _timeout(self):
+        if self.ready:
+            return 0
+
+        with self.lock:
+            if not self.timers:
+                return self.POLL_INTERVAL
+
+            delay = self.timers[0].when - time.monotonic()
+
+        return min(max(delay, 0), self.POLL_INTERVAL)
+
+    def run(self):
+        try:
+            while not self.stopping and not self.cpu.exit_event.is_set():
+                for key, mask in self.selector.select(self._timeout()):
+                    if key.fd == self.wake_recv:
+                        try:
+                            while os.read(self.wake_recv, 4096):
+                                pass
+                        except BlockingIOError:
+                            pass
+                        continue
+
+                    with self.lock:
+                        reader = self.readers.get(key.fd) if mask & selectors.EVENT_READ else None
+                        writer = self.writers.get(key.fd) if mask & selectors.EVENT_WRITE else None
+
+                    if reader is not None:
+                        self._call(*reader)
+                    if writer is not None:
+                        self._call(*writer)
+
+                due = []
+                now = time.monotonic()
+                with self.lock:
+                    while self.timers and self.timers[0].when <= now:
+                        due.append(heapq.heappop(self.timers))
+
+                for call in due:
+                    if not call.cancelled:
+                        self._call(call.callback, call.args)
+
+                # Only what's queued now; callbacks queued by these run next
+                # time round, after we've checked for I/O
+                for _ in range(len(self.ready)):
+                    self._call(*self.ready.popleft())
+        finally:
+            for device in self.devices:
+                device.detach_loop()
+
+            self.selector.close()
+            wake_recv, wake_send = self.wake_recv, self.wake_send
+            self.wake_recv = self.wake_send = None
+            os.close(wake_recv)
+            os.close(wake_send)
@@ -1,5 +1,6 @@
 import enum
 import dataclasses
+from array import array
 
 
 class RegisterName(enum.IntEnum):
@@ -50,7 +51,10 @@ class RegisterName(enum.IntEnum):
     # Reserved for emulator usage
     REG_FC = 0x28      # Fault counter
     REG_RSVD = 0x29    # Reserved for internal use
-    REG_LAST = 0x2a
+
+    # Added later, so it comes after the registers above
+    REG_SYSVEC = 0x2a   # Syscall vector (privileged)
+    REG_LAST = 0x2b
 
 
 class StatusBit(enum.IntFlag):
@@ -71,28 +75,68 @@ class RegisterFile:
     # Privileged registers
     PRIV_REGS = (RegisterName.REG_STATUS,
                  RegisterName.REG_VADDR,
-                 RegisterName.REG_BPTR)
+                 RegisterName.REG_BPTR,
+                 RegisterName.REG_SYSVEC)
     
     # Disallowed registers
     DIS_REGS = (RegisterName.REG_FC,
                 RegisterName.REG_RSVD)
 
+    # Status bits as plain ints, the IntFlag operators are slow
+    MMU_ENABLE = int(StatusBit.MMU_ENABLE)
+    USER = int(StatusBit.USER)
+    INTR = int(StatusBit.INTR)
+
+    # The current, previous and old user/interrupt bit pairs
+    MODE_BITS = 0x3f
+
     def __init__(self, cpu):
-        self.registers = [0] * (RegisterName.REG_LAST)
+        # Signed 64-bit, as handlers pass through negative intermediates
+        # (sub) and the PC can run past the end of memory
+        self.registers = array('q', bytes(8 * RegisterName.REG_LAST))
         self.cpu = cpu
 
-    @property
-    def mmu_bit(self):
-        return self.registers[RegisterName.REG_STATUS] & StatusBit.MMU_ENABLE
+        # Copies of the most used status bits; read-only, they follow
+        # REG_STATUS through set_status()
+        self.mmu_bit = 0
+        self.user_bit = 0
+        self.intr_bit = 0
+
+    def set_status(self, val):
+        self.registers[RegisterName.REG_STATUS] = val
+        self.mmu_bit = val & self.MMU_ENABLE
+        self.user_bit = val & self.USER
+        self.intr_bit = val & self.INTR
+
+    def load(self, values):
+        # In place, translated blocks hold on to the array
+        self.registers[:] = array('q', values)
+        self.set_status(self.registers[RegisterName.REG_STATUS])
+
+    def push_mode(self):
+        # Entering the kernel: current bits become previous, previous become
+        # old, and we run in kernel mode with interrupts off
+        status = self.registers[RegisterName.REG_STATUS]
+        self.set_status((status & ~self.MODE_BITS) | ((status & 0xf) << 2))
+
+    def pop_mode(self):
+        # Leaving the kernel, the other way round; old bits stay as they are
+        status = self.registers[RegisterName.REG_STATUS]
+        self.set_status((status & ~0xf) | ((status >> 2) & 0xf))
+
+    def check_privilege(self):
+        # Instructions naming privileged registers call this before running,
+        # see CPU.decode()
+        if self.user_bit:
+            raise PrivilegeException()
 
-    @mmu_bit.setter
-    def mmu_bit(self, val):
-        # Force the MMU bit
+    def _set_status_bit(self, bit, val):
+        status = self.registers[RegisterName.REG_STATUS]
         if val:
-            self.registers[RegisterName.REG_STATUS] |= StatusBit.MMU_ENABLE
+            self.set_status(status | bit)
         else:
-            self.registers[RegisterName.REG_STATUS] &= ~StatusBit.MMU_ENABLE
-    
+            self.set_status(status & ~bit)
+
     @property
     def user_old_bit(self):
         return self.registers[RegisterName.REG_STATUS] & StatusBit.USER_OLD
@@ -100,10 +144,7 @@ class RegisterFile:
     @user_old_bit.setter
     def user_old_bit(self, val):
         # Force set the user bit
-        if val:
-            self.registers[RegisterName.REG_STATUS] |= StatusBit.USER_OLD
-        else:
-            self.registers[RegisterName.REG_STATUS] &= ~StatusBit.USER_OLD
+        self._set_status_bit(StatusBit.USER_OLD, val)
 
     @property
     def intr_old_bit(self):
@@ -112,10 +153,7 @@ class RegisterFile:
     @intr_old_bit.setter
     def intr_old_bit(self, val):
         # Force set the intr bit
-        if val:
-            self.registers[RegisterName.REG_STATUS] |= StatusBit.INTR_OLD
-        else:
-            self.registers[RegisterName.REG_STATUS] &= ~StatusBit.INTR_OLD
+        self._set_status_bit(StatusBit.INTR_OLD, val)
 
     @property
     def user_prev_bit(self):
@@ -124,10 +162,7 @@ class RegisterFile:
     @user_prev_bit.setter
     def user_prev_bit(self, val):
         # Force set the user bit
-        if val:
-            self.registers[RegisterName.REG_STATUS] |= StatusBit.USER_PREV
-        else:
-            self.registers[RegisterName.REG_STATUS] &= ~StatusBit.USER_PREV
+        self._set_status_bit(StatusBit.USER_PREV, val)
 
     @property
     def intr_prev_bit(self):
@@ -136,34 +171,7 @@ class RegisterFile:
     @intr_prev_bit.setter
     def intr_prev_bit(self, val):
         # Force set the intr bit
-        if val:
-            self.registers[RegisterName.REG_STATUS] |= StatusBit.INTR_PREV
-        else:
-            self.registers[RegisterName.REG_STATUS] &= ~StatusBit.INTR_PREV
-
-    @property
-    def user_bit(self):
-        return self.registers[RegisterName.REG_STATUS] & StatusBit.USER
-
-    @user_bit.setter
-    def user_bit(self, val):
-        # Force set the user bit
-        if val:
-            self.registers[RegisterName.REG_STATUS] |= StatusBit.USER
-        else:
-            self.registers[RegisterName.REG_STATUS] &= ~StatusBit.USER
-
-    @property
-    def intr_bit(self):
-        return self.registers[RegisterName.REG_STATUS] & StatusBit.INTR
-
-    @intr_bit.setter
-    def intr_bit(self, val):
-        # Force set the intr bit
-        if val:
-            self.registers[RegisterName.REG_STATUS] |= StatusBit.INTR
-        else:
-            self.registers[RegisterName.REG_STATUS] &= ~StatusBit.INTR
+        self._set_status_bit(StatusBit.INTR_PREV, val)
 
     @property
     def vaddr(self, val):
@@ -192,26 +200,21 @@ class RegisterFile:
         self.registers[RegisterName.REG_RSVD] = val
 
     def __getitem__(self, item):
-        if item in self.PRIV_REGS and self.user_bit:
-            raise PrivilegeException()
-
+        # Privilege was checked when the instruction was decoded
         return self.registers[item]
 
     def __setitem__(self, item, val):
-        if item in self.PRIV_REGS and self.user_bit:
-            raise PrivilegeException()
-
-        self.registers[item] = val
-
-        # XXX - this is messy
-        cur_intr = self.intr_bit
-        if cur_intr and self.cpu.intr_pending:
-            # Fire interrupt if enabled.
-            self.cpu.intr()
+        if item == RegisterName.REG_STATUS:
+            self.set_status(val)
+        else:
+            self.registers[item] = val
 
     def pretty_format(self):
         ret = []
-        for i, x in enumerate(self.registers[0:-1]):
+        for i, x in enumerate(self.registers):
+            if i == RegisterName.REG_RSVD:
+                continue
+
             reg_name = RegisterName(i).name
             ret.append(f"{reg_name:10} = 0x{x:08x}")
 
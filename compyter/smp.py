@@ -0,0 +1,141 @@
+from . import cpu, memory, aot, reactor
+from .hardware import printer, intc, timer, keyboard, storage, internet, rtc
+from multiprocessing import shared_memory
+from threading import Thread
+import multiprocessing
+
+
+def _ipi_watcher(core, controller, event):
+    while not core.exit_event.is_set():
+        if not event.wait(0.1):
+            continue
+
+        event.clear()
+
+        # Another core may have rewritten code we have cached
+        with core.cpu_lock:
+            core.flush_code()
+
+        controller.interrupt(controller.INT_IPI)
+
+
+def _build_core(core_id, ram, trap_vectors, events, filename, translate):
+    mem = memory.Memory(ram, trap_vectors)
+    core = cpu.CPU(mem, core_id)
+
+    if translate:
+        aot.load_translations(core, filename)
+
+    loop = reactor.Reactor(core)
+    controller = intc.InterruptController(core, mem)
+    controller.ipi_sender = lambda target: _send_ipi(events, target)
+    mem.attach_hardware(controller)
+    loop.attach(controller)
+
+    watcher = Thread(target=_ipi_watcher, args=(core, controller, events[core_id]),
+                     daemon=True)
+    watcher.start()
+    core.register_thread(watcher)
+
+    return mem, core, controller, loop
+
+
+def _send_ipi(events, target):
+    if 0 <= target < len(events):
+        events[target].set()
+
+
+def _core_main(core_id, ram_name, size, vectors_name, events, filename,
+               quantum, translate):
+    ram_shm = shared_memory.SharedMemory(ram_name)
+    vectors_shm = shared_memory.SharedMemory(vectors_name)
+
+    mem, core, controller, loop = _build_core(core_id, ram_shm.buf[:size],
+                                              vectors_shm.buf, events, filename,
+                                              translate)
+
+    # Secondary cores only get the devices that make sense per core
+    for device in (timer.Timer(core, mem, controller), printer.Printer(core, mem),
+                   rtc.RTC(core, mem)):
+        mem.attach_hardware(device)
+        loop.attach(device)
+    loop.start()
+
+    while not core.halted:
+        core.run(quantum, translate)
+
+
+class SMPMachine:
+    def __init__(self, filename, cores=2, quantum=1000, translate=False, ram_size=None):
+        self.filename = filename
+        self.cores = cores
+        self.quantum = quantum
+        self.translate = translate
+
+        with open(filename, 'rb') as f:
+            image = f.read()
+
+        self.size = max(len(image), 4096)
+        if ram_size is not None:
+            if not len(image) <= ram_size <= memory.Memory.MAX_RAM:
+                raise ValueError(f"RAM size must be between the image's size and "
+                                 f"{memory.Memory.MAX_RAM:#x} bytes")
+
+            # Shared memory is only backed once written, like allocate()'s
+            self.size = ram_size
+
+        # RAM and trap vectors are shared by all cores; everything else,
+        # including MMIO devices, is per core.
+        self.ram_shm = shared_memory.SharedMemory(create=True, size=self.size)
+        self.vectors_shm = shared_memory.SharedMemory(create=True, size=4096)
+        self.ram_shm.buf[:len(image)] = image
+
+        self.ctx = multiprocessing.get_context("fork")
+        self.events = [self.ctx.Event() for _ in range(cores)]
+        self.processes = []
+
+    def start_secondaries(self):
+        for core_id in range(1, self.cores):
+            p = self.ctx.Process(target=_core_main, daemon=True,
+                                 args=(core_id, self.ram_shm.name, self.size,
+                                       self.vectors_shm.name, self.events,
+                                       self.filename, self.quantum, self.translate))
+            p.start()
+            self.processes.append(p)
+
+    def run(self):
+        self.start_secondaries()
+
+        ram = self.ram_shm.buf[:self.size]
+        self.memory, self.cpu, self.intc, self.reactor = _build_core(
+            0, ram, self.vectors_shm.buf, self.events, self.filename, self.translate)
+
+        # Core 0 owns the devices that can't be shared out
+        for device in (timer.Timer(self.cpu, self.memory, self.intc),
+                       keyboard.Keyboard(self.cpu, self.memory, self.intc),
+                       printer.Printer(self.cpu, self.memory),
+                       storage.Storage(self.cpu, self.memory),
+                       internet.Internet(self.cpu, self.memory, self.intc),
+                       rtc.RTC(self.cpu, self.memory)):
+            self.memory.attach_hardware(device)
+            self.reactor.attach(device)
+        self.reactor.start()
+
+        try:
+            while not self.cpu.halted:
+                self.cpu.run(self.quantum, self.translate)
+
+            print(self.cpu.registers.pretty_format())
+        finally:
+            # Core 0 halting brings the whole machine down
+            for p in self.processes:
+                p.terminate()
+                p.join()
+
+            self.memory.memory = None
+            self.memory.trap_vectors = None
+            ram.release()
+
+            for shm in (self.ram_shm, self.vectors_shm):
+                shm.close()
+                shm.unlink()
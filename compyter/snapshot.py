@@ -0,0 +1,181 @@
+from . import machine, memory
+from .register import RegisterName
+import json
+import mmap
+import os
+import struct
+import uuid
+
+
+# A snapshot is a header, then JSON describing the CPU and devices, then RAM
+# on its own page boundary so restore() can map it straight in. An
+# incremental snapshot has only the pages written since the snapshot it's
+# based on, one after the other.
+MAGIC = b"ELISNAP\0"
+VERSION = 3
+HEADER = struct.Struct(">8sII")
+
+# Version 1 is version 2 without incremental snapshots, and version 2 is
+# version 3 with REG_SYSVEC before REG_FC and REG_RSVD rather than after
+READABLE = (1, 2, 3)
+
+
+def _align(offset):
+    granularity = mmap.ALLOCATIONGRANULARITY
+    return (offset + granularity - 1) // granularity * granularity
+
+
+def save(m, filename, base=None):
+    # Take the machine between runs, not while run_until() is going. A guest
+    # saved in wait carries on with the instruction after it.
+    #
+    # With base, the snapshot this machine was last saved to or restored
+    # from, only pages written since then are saved.
+    cpu = m.cpu
+    state = {
+        "id": uuid.uuid4().hex,
+        "image": m.filename,
+        "symbols": m.symbols,
+        "registers": list(cpu.registers.registers),
+        "intr_pending": cpu.intr_pending,
+        "halted": cpu.halted,
+        "instructions": cpu.instructions,
+        "trap_vectors": bytes(m.memory.trap_vectors).hex(),
+        "devices": {name: getattr(m, name).save_state() for name in machine.DEVICES
+                    if getattr(m, name) is not None},
+        "ram_size": len(m.memory.memory),
+    }
+
+    if base is not None:
+        base_id = load_state(base)["id"]
+        if base_id != m.snapshot_id:
+            raise ValueError(f"{base} isn't the last snapshot of this machine")
+
+        # Relative to where we are, so the two can be moved together
+        state["base"] = os.path.relpath(os.path.abspath(base),
+                                        os.path.dirname(os.path.abspath(filename)))
+        state["base_id"] = base_id
+
+    # Pages are only marked clean once the snapshot is written, so a failed
+    # save leaves them for the next. A full snapshot has them all anyway.
+    m.memory.track_dirty("snapshot")
+    pages = m.memory.dirty_pages("snapshot")
+    if base is not None:
+        state["pages"] = pages
+
+    # RAM's offset is part of the JSON, and the JSON decides the offset. Pages
+    # of an incremental snapshot are copied in, not mapped, so aren't aligned.
+    ram_offset = 0
+    while True:
+        state["ram_offset"] = ram_offset
+        data = json.dumps(state).encode()
+        if HEADER.size + len(data) <= ram_offset:
+            break
+
+        ram_offset = HEADER.size + len(data)
+        if base is None:
+            ram_offset = _align(ram_offset)
+
+    ram = m.memory.memory
+    size = m.memory.PAGE_SIZE
+    with open(filename, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(data)))
+        f.write(data)
+        f.write(bytes(ram_offset - HEADER.size - len(data)))
+        if base is None:
+            # Pages that are all zero are left as holes, so a big guest that
+            # has only touched a little of its RAM makes a small file
+            zero = bytes(size)
+            for page in range(m.memory.pages()):
+                data = ram[page * size:(page + 1) * size]
+                if data != zero:
+                    if f.tell() != ram_offset + page * size:
+                        f.seek(ram_offset + page * size)
+                    f.write(data)
+            f.truncate(ram_offset + len(ram))
+        else:
+            for page in pages:
+                f.write(ram[page * size:(page + 1) * size])
+
+    m.memory.clear_dirty("snapshot", pages)
+    m.snapshot_id = state["id"]
+
+
+def load_state(filename):
+    # Just the JSON part
+    with open(filename, "rb") as f:
+        magic, version, length = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(f"{filename} is not a snapshot")
+
+        if version not in READABLE:
+            raise ValueError(f"{filename} is a version {version} snapshot, "
+                             f"we only read versions {READABLE}")
+
+        state = json.loads(f.read(length))
+
+    if version < 3:
+        # REG_SYSVEC was where REG_FC is now
+        registers = state["registers"]
+        registers.append(registers.pop(RegisterName.REG_FC))
+
+    return state
+
+
+def _load_ram(filename, state):
+    if "base" not in state:
+        with open(filename, "rb") as f:
+            return mmap.mmap(f.fileno(), state["ram_size"], offset=state["ram_offset"],
+                             access=mmap.ACCESS_COPY)
+
+    base = os.path.join(os.path.dirname(filename), state["base"])
+    base_state = load_state(base)
+    if base_state.get("id") != state["base_id"]:
+        raise ValueError(f"{base} isn't the snapshot {filename} was based on")
+
+    # Copy-on-write, so this doesn't touch the base either
+    ram = _load_ram(base, base_state)
+    size = memory.Memory.PAGE_SIZE
+    with open(filename, "rb") as f:
+        f.seek(state["ram_offset"])
+        for page in state["pages"]:
+            data = f.read(size)
+            ram[page * size:page * size + len(data)] = data
+
+    return ram
+
+
+def restore(filename, translate=False, storage_file=None, input_stream=None,
+            output=None, asynchronous=False, devices=None, remote_devices=None):
+    # Build a machine from a snapshot, with the devices it had unless told
+    # otherwise. RAM is mapped copy-on-write, so restoring is quick however
+    # big the guest, and the snapshot is left as it was; an incremental
+    # snapshot is applied over its base. Storage is only attached if a
+    # storage_file is given.
+    state = load_state(filename)
+    ram = _load_ram(filename, state)
+
+    mem = memory.Memory(ram, bytearray.fromhex(state["trap_vectors"]))
+    mem.track_dirty("snapshot")
+
+    if devices is None:
+        devices = list(state["devices"])
+
+    m = machine.Machine(state["image"], translate, storage_file, input_stream, output,
+                        asynchronous, devices, mem, remote_devices)
+    m.symbols = state["symbols"]
+    m.snapshot_id = state.get("id")
+
+    cpu = m.cpu
+    cpu.registers.load(state["registers"])
+    cpu.halted = state["halted"]
+    cpu.instructions = state["instructions"]
+    if state["intr_pending"]:
+        cpu.raise_interrupt()
+
+    for name, device_state in state["devices"].items():
+        device = getattr(m, name)
+        if device is not None:
+            device.load_state(device_state)
+
+    return m
@@ -0,0 +1,340 @@
+from .register import RegisterName
+from collections import defaultdict
+
+
+REG_PC = int(RegisterName.REG_PC)
+REG_CARRY = int(RegisterName.REG_CARRY)
+REG_STATUS = int(RegisterName.REG_STATUS)
+
+
+class _BlockBuilder:
+    # Emits the source for one block, keeping registers in locals
+
+    def __init__(self, entry):
+        self.entry = entry
+        self.name = f"block_{entry:08x}"
+        self.lines = [f"def {self.name}(cpu):", "    r = cpu.registers.registers"]
+        self.loaded = set()
+        self.dirty = set()
+
+    def emit(self, line, indent=1):
+        self.lines.append(("    " * indent) + line)
+
+    def read(self, reg):
+        if reg not in self.loaded:
+            self.emit(f"r{reg} = r[{reg:#x}]")
+            self.loaded.add(reg)
+
+        return f"r{reg}"
+
+    def write(self, reg):
+        self.loaded.add(reg)
+        self.dirty.add(reg)
+        return f"r{reg}"
+
+    def writeback(self, indent=1):
+        for reg in sorted(self.dirty):
+            self.emit(f"r[{reg:#x}] = r{reg}", indent)
+
+    def exit(self, target, count, indent=1):
+        self.writeback(indent)
+        self.emit(f"r[{REG_PC:#x}] = {target}", indent)
+        self.emit(f"return {count}", indent)
+
+    def source(self):
+        return "\n".join(self.lines) + "\n"
+
+
+class Translator:
+    # Longest block we will translate in one go
+    MAX_BLOCK = 64
+
+    # Registers that may live in locals; the rest need the register file's
+    # privilege checks or are the PC itself.
+    LOCAL_REGS = frozenset(list(range(RegisterName.REG_0, RegisterName.REG_31 + 1)) +
+                           [RegisterName.REG_SP, RegisterName.REG_RES,
+                            RegisterName.REG_CARRY, RegisterName.REG_RET])
+
+    # Instructions after which a block always ends
+    BLOCK_END = frozenset(("jmp", "jmpr", "jmplt", "jmpgt", "jmple", "jmpge",
+                           "jmpeq", "jmpne", "jmplti", "jmpgti", "jmplei",
+                           "jmpgei", "jmpeqi", "jmpnei", "jmpltr", "jmpgtr",
+                           "jmpler", "jmpger", "jmpeqr", "jmpner", "jmpltri",
+                           "jmpgtri", "jmpleri", "jmpgeri", "jmpeqri",
+                           "jmpneri", "halt", "intr", "rfe", "wait",
+                           "syscall", "sysret"))
+
+    # Instructions that write memory, and so may overwrite the running block
+    STORES = frozenset(("savew", "saveb", "savewr", "savebr", "savewi",
+                        "savebi", "savewri", "savebri", "strapr", "strapi"))
+
+    # name: (register operands, result expression); sets the carry register
+    ARITH = {
+        "add": ((0, 1, 2), "{0} + {1}"),
+        "addi": ((0, 2), "{0} + {1}"),
+        "sub": ((0, 1, 2), "{0} + (~{1} + 1)"),
+        "subi": ((0, 2), "{0} + (~{1} + 1)"),
+        "mul": ((0, 1, 2), "{0} * {1}"),
+        "muli": ((0, 2), "{0} * {1}"),
+    }
+
+    # name: (register operands, result expression)
+    LOGIC = {
+        "and_": ((0, 1, 2), "{0} & {1}"),
+        "andi": ((0, 2), "{0} & {1}"),
+        "or_": ((0, 1, 2), "{0} | {1}"),
+        "ori": ((0, 2), "{0} | {1}"),
+        "xor_": ((0, 1, 2), "{0} ^ {1}"),
+        "xori": ((0, 2), "{0} ^ {1}"),
+        "shl": ((0, 1, 2), "({0} << {1}) & 0xffffffff"),
+        "shli": ((0, 2), "({0} << {1}) & 0xffffffff"),
+        "shr": ((0, 1, 2), "{0} >> {1}"),
+        "shri": ((0, 2), "{0} >> {1}"),
+    }
+
+    # Branch conditions; signed comparisons bias both sides by 0x80000000
+    CONDITIONS = {
+        "lt": ("<", True),
+        "gt": (">", True),
+        "le": ("<=", True),
+        "ge": (">=", True),
+        "eq": ("==", False),
+        "ne": ("!=", False),
+    }
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.memory = cpu.memory
+
+        # (function, instructions) by entry PC
+        self.blocks = {}
+        self.block_lines = defaultdict(list)
+        self.memory.add_code_watcher(self.invalidate_code)
+
+        # Operand types of each instruction, by handler name
+        self.arg_types = {fn.__name__: [t for t in instr_type if t != cpu.IA_NONE]
+                          for instr_type, fn in cpu.INSTRS}
+
+    def invalidate_code(self, line):
+        for pc in self.block_lines.pop(line, ()):
+            self.blocks.pop(pc, None)
+
+    def lookup(self, pc):
+        block = self.blocks.get(pc)
+        if block is None:
+            block = self.translate(pc)
+
+        return block
+
+    def fetch(self, addr):
+        # Decode an instruction without side effects; None if it can't be
+        # translated and must be left to the interpreter.
+        if self.memory.is_mmio(addr, 16) or addr + 16 > len(self.memory):
+            return None
+
+        words = [self.memory.read_word(i) for i in range(addr, addr + 16, 4)]
+
+        opcode = words[0]
+        if opcode >= len(self.cpu.INSTRS):
+            return None
+
+        instr_type, instr_fn = self.cpu.INSTRS[opcode]
+        args = []
+        for argtype, arg in zip(instr_type, words[1:]):
+            if argtype == self.cpu.IA_NONE:
+                continue
+            elif argtype == self.cpu.IA_REG and arg in self.cpu.registers.DIS_REGS:
+                return None
+
+            args.append(arg)
+
+        return (instr_fn.__name__, tuple(args))
+
+    def privileged(self, name, args):
+        # Whether the instruction names a privileged register
+        return any(argtype == self.cpu.IA_REG and arg in self.cpu.registers.PRIV_REGS
+                   for argtype, arg in zip(self.arg_types[name], args))
+
+    def uses_status(self, name, args):
+        # Whether the instruction names the status register. One that writes
+        # it may switch the MMU or the mode, so the block ends after it
+        # rather than run on from code fetched before.
+        return any(argtype == self.cpu.IA_REG and arg == REG_STATUS
+                   for argtype, arg in zip(self.arg_types[name], args))
+
+    def scan(self, pc):
+        instrs = []
+        addr = pc
+        while len(instrs) < self.MAX_BLOCK:
+            instr = self.fetch(addr)
+            if instr is None:
+                break
+
+            instrs.append(instr)
+            addr += 16
+            if instr[0] in self.BLOCK_END or self.uses_status(*instr):
+                break
+
+        return instrs
+
+    def generate(self, pc, instrs):
+        b = _BlockBuilder(pc)
+        for count, (name, args) in enumerate(instrs, 1):
+            next_pc = pc + (count * 16)
+            if not self._generate_inline(b, name, args, next_pc, count):
+                self._generate_call(b, name, args, next_pc, count)
+
+        if instrs[-1][0] not in self.BLOCK_END:
+            # Fell off the end of the block
+            b.exit(f"{pc + (len(instrs) * 16):#x}", len(instrs))
+
+        return b.name, b.source()
+
+    def _is_local(self, args, positions):
+        return all(args[i] in self.LOCAL_REGS for i in positions)
+
+    def _operands(self, b, args, positions):
+        return [b.read(arg) if i in positions else f"{arg:#x}"
+                for i, arg in enumerate(args)]
+
+    def _generate_inline(self, b, name, args, next_pc, count):
+        if name == "nop":
+            return True
+        elif name in ("loadwi", "loadbi"):
+            if not self._is_local(args, (0,)):
+                return False
+
+            mask = 0xffffffff if name == "loadwi" else 0xff
+            b.emit(f"{b.write(args[0])} = {args[1] & mask:#x}")
+            return True
+        elif name == "copy":
+            if not self._is_local(args, (0, 1)):
+                return False
+
+            src = b.read(args[1])
+            b.emit(f"{b.write(args[0])} = {src}")
+            return True
+        elif name == "not_":
+            if not self._is_local(args, (0, 1)):
+                return False
+
+            src = b.read(args[0])
+            b.emit(f"{b.write(args[1])} = (~{src}) & 0xffffffff")
+            return True
+        elif name in self.ARITH:
+            positions, expr = self.ARITH[name]
+            if not self._is_local(args, positions):
+                return False
+
+            ops = self._operands(b, args[:2], positions)
+            b.emit("t = " + expr.format(*ops))
+            b.emit(f"{b.write(args[2])} = t & 0xffffffff")
+            b.emit(f"{b.write(REG_CARRY)} = int(t > 0xffffffff)")
+            return True
+        elif name in ("divi", "modi"):
+            # Division by zero traps, so leave that to the handler
+            if args[1] == 0 or not self._is_local(args, (0, 2)):
+                return False
+
+            src = b.read(args[0])
+            b.emit(f"t = cpu._divmod({src}, {args[1]:#x})")
+            b.emit(f"{b.write(args[2])} = t[{int(name == 'modi')}] & 0xffffffff")
+            b.emit(f"{b.write(REG_CARRY)} = 0")
+            return True
+        elif name in self.LOGIC:
+            positions, expr = self.LOGIC[name]
+            if not self._is_local(args, positions):
+                return False
+
+            ops = self._operands(b, args[:2], positions)
+            b.emit(f"{b.write(args[2])} = " + expr.format(*ops))
+            return True
+        elif name == "jmp":
+            b.exit(f"{args[0]:#x}", count)
+            return True
+        elif name == "jmpr":
+            if not self._is_local(args, (0,)):
+                return False
+
+            b.exit(b.read(args[0]), count)
+            return True
+        elif name.startswith("jmp") and name[3:5] in self.CONDITIONS:
+            return self._generate_branch(b, name, args, next_pc, count)
+
+        return False
+
+    def _generate_branch(self, b, name, args, next_pc, count):
+        op, signed = self.CONDITIONS[name[3:5]]
+        suffix = name[5:]
+
+        reg_positions = {"": (0, 1), "i": (0,), "r": (0, 1, 2), "ri": (0, 2)}[suffix]
+        if not self._is_local(args, reg_positions):
+            return False
+
+        # The target is read before the comparison, as in the interpreter
+        if suffix in ("r", "ri"):
+            target = b.read(args[2])
+        else:
+            target = f"{args[2]:#x}"
+
+        lhs = b.read(args[0])
+        if suffix in ("", "r"):
+            rhs = b.read(args[1])
+        else:
+            rhs = args[1]
+
+        if signed:
+            lhs = f"({lhs} ^ 0x80000000)"
+            if isinstance(rhs, int):
+                rhs = f"{rhs ^ 0x80000000:#x}"
+            else:
+                rhs = f"({rhs} ^ 0x80000000)"
+        elif isinstance(rhs, int):
+            rhs = f"{rhs:#x}"
+
+        b.emit(f"if {lhs} {op} {rhs}:")
+        b.exit(target, count, indent=2)
+        b.exit(f"{next_pc:#x}", count)
+        return True
+
+    def _generate_call(self, b, name, args, next_pc, count):
+        # Hand the instruction to the interpreter's handler with the
+        # register file in sync, so traps and exceptions stay precise.
+        b.writeback()
+        b.dirty.clear()
+        b.loaded.clear()
+
+        b.emit(f"r[{REG_PC:#x}] = {next_pc:#x}")
+        if self.privileged(name, args):
+            b.emit("cpu.registers.check_privilege()")
+
+        b.emit(f"cpu.{name}({', '.join(f'{arg:#x}' for arg in args)})")
+
+        if name in self.BLOCK_END:
+            b.emit(f"return {count}")
+            return
+
+        b.emit(f"if r[{REG_PC:#x}] != {next_pc:#x}:")
+        b.emit(f"return {count}", 2)
+        if name in self.STORES:
+            b.emit(f"if {b.entry:#x} not in cpu.translator.blocks:")
+            b.emit(f"return {count}", 2)
+
+    def install(self, pc, fn, length):
+        self.blocks[pc] = (fn, length)
+        for line in self.memory.lines_of(pc, length * 16):
+            self.block_lines[line].append(pc)
+
+        self.memory.watch_code(pc, length * 16)
+
+    def translate(self, pc):
+        instrs = self.scan(pc)
+        if not instrs:
+            return None
+
+        name, source = self.generate(pc, instrs)
+        namespace = {}
+        exec(compile(source, f"<block {pc:#010x}>", "exec"), namespace)
+
+        self.install(pc, namespace[name], len(instrs))
+        return self.blocks[pc]
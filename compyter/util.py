@@ -3,10 +3,10 @@ def in_range(c, a, b):
 
 def set_word_byte(num, byte, val):
     mask_table = [
-        0x00ffffff,
-        0xff00ffff,
-        0xffff00ff,
         0xffffff00,
+        0xffff00ff,
+        0xff00ffff,
+        0x00ffffff,
     ]
     val &= 0xff
     byte = 3 - byte
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+from compyter import fleet
+import argparse
+import json
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run many images over a process pool")
+    parser.add_argument("images", nargs="+")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="worker processes (default: one per core)")
+    parser.add_argument("--storage", default=None, help="storage image for every job")
+    parser.add_argument("--input", default=None, help="file typed into the keyboard")
+    parser.add_argument("--max-instructions", type=int, default=None)
+    parser.add_argument("--timeout", type=float, default=None, help="seconds per job")
+    parser.add_argument("--translate", action="store_true")
+    parser.add_argument("--devices", default=None,
+                        help="comma separated devices to attach (default: all)")
+    args = parser.parse_args()
+
+    input_data = b""
+    if args.input is not None:
+        with open(args.input, 'rb') as f:
+            input_data = f.read()
+
+    devices = None
+    if args.devices is not None:
+        devices = args.devices.split(",")
+
+    jobs = [fleet.Job(image, args.storage, input_data, args.max_instructions,
+                      args.timeout, args.translate, devices=devices)
+            for image in args.images]
+
+    # One JSON object per line, as jobs finish
+    with fleet.Fleet(args.jobs) as f:
+        for result in f.run(jobs):
+            print(json.dumps(result), flush=True)
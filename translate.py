@@ -0,0 +1,12 @@
+#!/usr/bin/env python3
+from compyter import aot
+from sys import argv
+
+
+if __name__ == "__main__":
+    if len(argv) < 2:
+        filename_in = "image"
+    else:
+        filename_in = argv[1]
+
+    print(aot.translate_image(filename_in))